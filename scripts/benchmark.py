@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from copy import deepcopy
+from tempfile import TemporaryDirectory
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+
+from stub_wiki import LATENCY, StubWiki
+from synthetic_users import ACCOUNT_FIELDS, generate_accounts, generate_files, write_csv
+
+BENCHMARKS = ("update_users_excel", "create_accounts", "upload_files")
+
+USERS = [10000, 100000]
+ACCOUNTS = [1000]
+FILES = [500]
+FILE_SIZE = 64 * 1024
+WORKERS = 8
+REPEAT = 3
+
+SCRIPTS_PATH = os.path.dirname(os.path.abspath(__file__))
+UPDATE_USERS_EXCEL_PATH = os.path.join(SCRIPTS_PATH, "update_users_excel")
+
+
+def get_peak_mib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_update_users_excel(uri, engine, directory):
+    """
+    Fetches the users from the stub Special:Userexport page, builds the workbook and uploads it. Meant to run in a
+    fresh process, like the other `run_` functions, so that the peak memory usage of the process is the peak of this
+    run alone.
+    :param uri: Stub wiki URI.
+    :param engine: Workbook engine value.
+    :param directory: Directory for the files of the run.
+    :return: Seconds taken, peak memory usage in MiB and number of requests.
+    """
+
+    sys.path.insert(0, UPDATE_USERS_EXCEL_PATH)
+    from update_users_excel import CONFIG, ConfigModel, MainController, WorkbookEngine
+
+    config = deepcopy(CONFIG)
+    config.update({
+        "wiki_uri": uri,
+        "wiki_session_cache_path": "",
+        "users_excel_file_path": os.path.join(directory, config["users_excel_file_name"]),
+        "workbook_engine": WorkbookEngine(engine),
+        "force_upload": True
+    })
+    main_controller = MainController(ConfigModel(config))
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        main_controller.run()
+        seconds = time.perf_counter() - start
+
+    requests = sum(metrics.count for metrics in main_controller.request_metrics.actions.values())
+
+    return seconds, get_peak_mib(), requests
+
+
+def run_create_accounts(uri, accounts, workers, directory):
+    """
+    Imports synthetic accounts from a CSV file into the stub wiki.
+    :param uri: Stub wiki URI.
+    :param accounts: Number of accounts.
+    :param workers:
+    :param directory: Directory for the files of the run.
+    :return: Seconds taken, peak memory usage in MiB and number of requests.
+    """
+
+    import create_accounts
+    from journal import Journal
+
+    create_accounts.WIKI_URI = uri
+    create_accounts.API_ENDPOINT = uri + "/api.php"
+
+    path = os.path.join(directory, "accounts.csv")
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        write_csv(generate_accounts(accounts), file, ACCOUNT_FIELDS)
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        create_accounts.resume_session_or_login({"username": "Admin", "password": "adminpass", "return_uri": uri, "session_cache_path": ""})
+        with Journal(os.path.join(directory, "create_accounts.journal.jsonl")) as journal:
+            create_accounts.import_accounts({
+                "path": path,
+                "create_account_token": create_accounts.fetch_create_account_token(),
+                "user_rights_token": create_accounts.fetch_user_rights_token(),
+                "return_uri": uri,
+                "workers": workers,
+                "journal": journal
+            })
+        seconds = time.perf_counter() - start
+
+    requests = sum(metrics.count for metrics in create_accounts.request_metrics.actions.values())
+
+    return seconds, get_peak_mib(), requests
+
+
+def run_upload_files(uri, files, file_size, workers, directory):
+    """
+    Uploads synthetic files to the stub wiki. The files are generated before the clock starts.
+    :param uri: Stub wiki URI.
+    :param files: Number of files.
+    :param file_size: Size of each file in bytes.
+    :param workers:
+    :param directory: Directory for the files of the run.
+    :return: Seconds taken, peak memory usage in MiB and number of requests.
+    """
+
+    import upload_files
+    from journal import Journal
+
+    upload_files.WIKI_URI = uri
+    upload_files.API_ENDPOINT = uri + "/api.php"
+
+    files = list(generate_files(files, file_size))
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        upload_files.resume_session_or_login({"username": "Admin", "password": "adminpass", "return_uri": uri, "session_cache_path": ""})
+        with Journal(os.path.join(directory, "upload_files.journal.jsonl")) as journal:
+            upload_files.upload_changed_files({
+                "files": files,
+                "token": upload_files.fetch_csrf_token(),
+                "workers": workers,
+                "cache_path": os.path.join(directory, "upload_files.sqlite"),
+                "journal": journal
+            })
+        seconds = time.perf_counter() - start
+
+    requests = sum(metrics.count for metrics in upload_files.request_metrics.actions.values())
+
+    return seconds, get_peak_mib(), requests
+
+
+def run_case(stub_users, latency, function, *args):
+    """
+    Runs a benchmark in a fresh process against a fresh stub wiki, repeatedly.
+    :param stub_users: Number of users the stub wiki exports.
+    :param latency: Stub wiki latency.
+    :param function: One of the `run_` functions.
+    :param args: Arguments of `function` after the URI, without the directory.
+    :return: Seconds taken, peak memory usage in MiB and number of requests.
+    """
+
+    # Spawned rather than forked, so that the process does not inherit the memory and the threads of this one.
+    context = multiprocessing.get_context("spawn")
+    with StubWiki(users=stub_users, latency=latency) as stub_wiki, TemporaryDirectory() as directory:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            return executor.submit(function, stub_wiki.uri, *args, directory).result()
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description="Benchmarks the throughput and peak memory usage of the scripts against a local stub wiki.")
+    parser.add_argument("--benchmarks", help="Benchmarks to run.", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--users", help="Numbers of users to export for update_users_excel.", type=int, nargs="+", default=USERS, metavar="N")
+    parser.add_argument("--engines", help="Workbook engines for update_users_excel.", nargs="+", choices=("default", "write-only"), default=["default", "write-only"])
+    parser.add_argument("--accounts", help="Numbers of accounts to create for create_accounts.", type=int, nargs="+", default=ACCOUNTS, metavar="N")
+    parser.add_argument("--files", help="Numbers of files to upload for upload_files.", type=int, nargs="+", default=FILES, metavar="N")
+    parser.add_argument("--file-size", help="Size of each uploaded file in bytes.", type=int, default=FILE_SIZE)
+    parser.add_argument("--workers", help="Number of workers for create_accounts and upload_files.", type=int, default=WORKERS)
+    parser.add_argument("--latency", help="Seconds the stub wiki waits before answering each request.", type=float, default=LATENCY)
+    parser.add_argument("--repeat", help="Number of runs of each case. The median is reported.", type=int, default=REPEAT)
+    arguments = parser.parse_args(args or None)
+
+    cases = []
+    if "update_users_excel" in arguments.benchmarks:
+        for users in arguments.users:
+            for engine in arguments.engines:
+                cases.append(("update_users_excel", engine, users, users, run_update_users_excel, (engine,)))
+    if "create_accounts" in arguments.benchmarks:
+        for accounts in arguments.accounts:
+            cases.append(("create_accounts", f"{arguments.workers} workers", accounts, 0, run_create_accounts, (accounts, arguments.workers)))
+    if "upload_files" in arguments.benchmarks:
+        for files in arguments.files:
+            case = f"{arguments.workers} workers, {arguments.file_size // 1024} KiB"
+            cases.append(("upload_files", case, files, 0, run_upload_files, (files, arguments.file_size, arguments.workers)))
+
+    print(f"Stub wiki latency: {arguments.latency * 1000:g} ms, runs per case: {arguments.repeat}")
+    print(f"{'Benchmark':<20}{'Case':<24}{'Items':>10}{'Seconds':>10}{'Items/s':>12}{'Peak MiB':>10}{'Requests':>10}")
+    # Each case is (benchmark, case, number of items, number of users the stub wiki exports, function, arguments).
+    for benchmark, case, items, stub_users, function, function_args in cases:
+        results = [run_case(stub_users, arguments.latency, function, *function_args) for _ in range(arguments.repeat)]
+        seconds = statistics.median(result[0] for result in results)
+        peak_mib = max(result[1] for result in results)
+        requests = results[0][2]
+        print(f"{benchmark:<20}{case:<24}{items:>10}{seconds:>10.2f}{items / seconds:>12,.0f}{peak_mib:>10.1f}{requests:>10}")
+
+
+if __name__ == "__main__":
+    main()
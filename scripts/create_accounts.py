@@ -15,9 +15,25 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import argparse
+import asyncio
+import csv
+import io
+import ipaddress
+import json
+import re
+import sys
 import requests
 from urllib3.exceptions import InsecureRequestWarning
 
+from journal import Journal
+from rate_controller import RateController, mount_connection_pool, post_with_rate_control, split_into_batches
+from request_metrics import RequestMetrics
+from session_cache import SessionRefresher
+
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
 session = requests.Session()
@@ -29,6 +45,41 @@ API_ENDPOINT = WIKI_URI + "/api.php"
 USERNAME = "Admin"
 PASSWORD = "adminpass"
 
+JOURNAL_PATH = "./create_accounts.journal.jsonl"
+SESSION_CACHE_PATH = "./create_accounts.session.json"
+
+WORKERS = 8
+LIMIT = 100
+
+# Maximum number of users per `list=users` query, and the maximum for users with the "apihighlimits" right.
+USERS_QUERY_LIMIT = 50
+USERS_QUERY_HIGH_LIMIT = 500
+
+# https://www.mediawiki.org/wiki/Manual:$wgMaxNameChars
+MAX_USERNAME_LENGTH = 255
+# Characters MediaWiki does not allow in titles, and the ones it does not allow in usernames on top of them.
+INVALID_USERNAME_CHARACTERS = set("#<>[]|{}") | set("@:/")
+PERCENT_ENCODING_PATTERN = re.compile("%[0-9A-Fa-f]{2}")
+# Fields of an account that must be strings when they are given.
+ACCOUNT_STRING_FIELDS = ("username", "password", "email", "real_name")
+
+# Number of accounts `iterate_provisioned_accounts` reads and looks up at once.
+PROVISION_BATCH_SIZE = 1000
+
+# Statuses of `provision_accounts` results, for the account and for its groups.
+ACCOUNT_CREATED = "created"
+ACCOUNT_EXISTS = "exists"
+ACCOUNT_FAILED = "failed"
+ACCOUNT_GROUPED = "grouped"
+ACCOUNT_GROUPING_FAILED = "grouping failed"
+
+users_query_limit = None
+
+rate_controller = RateController(WORKERS)
+
+request_metrics = RequestMetrics()
+request_metrics.install(session)
+
 
 def fetch_tokens(type):
     body = {
@@ -80,6 +131,23 @@ def login(option):
 
     print(data)
 
+    return data
+
+
+session_refresher = SessionRefresher(session, login, fetch_tokens, request_metrics.record_retry)
+
+
+def resume_session_or_login(option):
+    return session_refresher.resume_session_or_login(API_ENDPOINT, option)
+
+
+def post_write(body, files=None):
+    return post_with_rate_control(session, API_ENDPOINT, body, rate_controller, files, on_retry=request_metrics.record_retry)
+
+
+def post_with_token(body, token_type, token_field="token", files=None):
+    return session_refresher.post_with_token(post_write, body, token_type, token_field, files)
+
 
 def change_user_group_membership(option):
     username = option["username"]
@@ -99,11 +167,14 @@ def change_user_group_membership(option):
     if "remove_groups" in option:
         body["remove"] = option["remove_groups"]
 
-    response = session.post(url=API_ENDPOINT, data=body)
+    response = post_with_token(body, "userrights")
 
     data = response.json()
 
-    print(data)
+    if option.get("verbose", True):
+        print(data)
+
+    return data
 
 
 def add_user_to_groups(option):
@@ -112,7 +183,152 @@ def add_user_to_groups(option):
 
     token = option["token"]
 
-    change_user_group_membership({"username": username, "add_groups": groups, "token": token})
+    return change_user_group_membership({
+        "username": username,
+        "add_groups": groups,
+        "token": token,
+        "verbose": option.get("verbose", True)
+    })
+
+
+def split_groups(groups):
+    if groups is None:
+        return []
+    if isinstance(groups, str):
+        return [group for group in groups.split("|") if group]
+    return list(groups)
+
+
+def split_iterable_into_batches(items, size):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def fetch_current_user_rights():
+    body = {
+        "action": "query",
+        "meta": "userinfo",
+        "uiprop": "rights",
+        "format": "json"
+    }
+
+    response = session.get(url=API_ENDPOINT, params=body)
+    data = response.json()
+
+    rights = data["query"]["userinfo"].get("rights", [])
+
+    return rights
+
+
+def get_users_query_limit():
+    global users_query_limit
+
+    if users_query_limit is None:
+        has_high_limits = "apihighlimits" in fetch_current_user_rights()
+        users_query_limit = (USERS_QUERY_HIGH_LIMIT if has_high_limits else USERS_QUERY_LIMIT)
+
+    return users_query_limit
+
+
+def fetch_users(option):
+    """
+    Looks up users with `list=users`, batching the usernames so that each request covers up to "limit" users.
+    :param option: "usernames" list, plus optional "properties" (`usprop`) and "limit". The limit defaults to the
+        highest one the logged in user is allowed.
+    :return: Dictionary of the requested username to its user info. Users that do not exist have a "missing" key.
+    """
+
+    usernames = list(option["usernames"])
+    properties = option.get("properties", "groups")
+    limit = option.get("limit") or get_users_query_limit()
+
+    users = {}
+
+    for batch in split_into_batches(usernames, limit):
+        body = {
+            "action": "query",
+            "list": "users",
+            "ususers": "|".join(batch),
+            "format": "json"
+        }
+
+        if properties:
+            body["usprop"] = properties
+
+        response = session.get(url=API_ENDPOINT, params=body)
+        data = response.json()
+
+        query = data["query"]
+
+        # The API answers with normalized names (e.g. "user_1" -> "User 1"), so map them back to the requested ones.
+        requested_names = {name: name for name in batch}
+        for normalized in query.get("normalized", []):
+            requested_names[normalized["to"]] = normalized["from"]
+
+        for user in query["users"]:
+            users[requested_names.get(user["name"], user["name"])] = user
+
+    return users
+
+
+def fetch_missing_usernames(usernames):
+    users = fetch_users({"usernames": usernames, "properties": None})
+    return [username for username in usernames if "missing" in users.get(username, {})]
+
+
+def change_users_group_membership(option):
+    """
+    Changes the group membership of many users. The current groups of all the users are fetched first, users that
+    already have the wanted membership are skipped, and the remaining `userrights` requests are sent in parallel.
+    :param option: "changes" dictionary of username to {"add_groups": ..., "remove_groups": ...}, "token", and an
+        optional "workers" count. Groups can be a list or a "|"-separated string.
+    :return: Dictionary of username to the `userrights` response data, or None if the user was skipped.
+    """
+
+    changes = option["changes"]
+
+    token = option["token"]
+    workers = option.get("workers", WORKERS)
+
+    users = fetch_users({"usernames": list(changes.keys()), "properties": "groups"})
+
+    results = {}
+    options = []
+
+    for username, change in changes.items():
+        user = users.get(username, {})
+        results[username] = None
+
+        if "missing" in user or "invalid" in user:
+            print(f"Skipping {username}: user does not exist.")
+            continue
+
+        current_groups = set(user.get("groups", []))
+        add_groups = [group for group in split_groups(change.get("add_groups")) if group not in current_groups]
+        remove_groups = [group for group in split_groups(change.get("remove_groups")) if group in current_groups]
+
+        if not add_groups and not remove_groups:
+            continue
+
+        membership_option = {"username": username, "token": token}
+        if add_groups:
+            membership_option["add_groups"] = "|".join(add_groups)
+        if remove_groups:
+            membership_option["remove_groups"] = "|".join(remove_groups)
+        options.append(membership_option)
+
+    if options:
+        mount_connection_pool(session, rate_controller, workers)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for membership_option, data in zip(options, executor.map(change_user_group_membership, options)):
+                results[membership_option["username"]] = data
+
+    return results
 
 
 def create_account(option):
@@ -129,87 +345,500 @@ def create_account(option):
         "password": password,
         "retype": password,
         "email": email,
-        "realname": "",
+        "realname": option.get("real_name", ""),
         "createreturnurl": return_uri,
         "createtoken": token,
         "format": "json"
     }
 
-    response = session.post(API_ENDPOINT, data=body)
+    response = post_with_token(body, "createaccount", "createtoken")
+
+    data = None
 
     try:
         data = response.json()
 
-        print(data)
+        if option.get("verbose", True):
+            print(data)
     except ValueError:
         print(response)
         print(response.content)
 
+    return data
+
 
 def create_accounts(option):
+    """
+    Creates the accounts. Unless "skip_existing" is false, the usernames are first looked up in batches and only the
+    accounts that do not exist yet are sent to `createaccount`. If a "journal" is given, the final status of each
+    account is recorded in it, and with "resume", the accounts it records as done are skipped.
+    :param option: "accounts" list, "token", "return_uri", and optional "skip_existing" flag, "journal" and "resume"
+        flag.
+    :return: Dictionary of username to the `createaccount` response data, or None if the account already existed or
+        was skipped.
+    """
+
     accounts = option["accounts"]
 
     token = option["token"]
     return_uri = option["return_uri"]
+    skip_existing = option.get("skip_existing", True)
+    journal = option.get("journal")
+    resume = option.get("resume", False)
+
+    results = {}
+
+    if resume and journal is not None:
+        unfinished_usernames = set(journal.filter_unfinished(account["username"] for account in accounts))
+        finished_accounts = [account for account in accounts if account["username"] not in unfinished_usernames]
+
+        for account in finished_accounts:
+            results[account["username"]] = None
+
+        if finished_accounts:
+            print(f"Skipping {len(finished_accounts)} account(s) the journal records as done.")
+
+        accounts = [account for account in accounts if account["username"] in unfinished_usernames]
+
+    if skip_existing:
+        usernames = [account["username"] for account in accounts]
+        missing_usernames = set(fetch_missing_usernames(usernames))
+
+        existing_usernames = [username for username in usernames if username not in missing_usernames]
+        for username in existing_usernames:
+            results[username] = None
+            if journal is not None:
+                journal.record_result(username, True, "exists")
+
+        if existing_usernames:
+            print(f"Skipping {len(existing_usernames)} existing account(s): {', '.join(existing_usernames)}")
+
+        accounts = [account for account in accounts if account["username"] in missing_usernames]
 
     for account in accounts:
         username = account["username"]
         password = account["password"]
         email = account["email"]
 
-        create_account({
-            "username": username,
-            "password": password,
-            "email": email,
-            "token": token,
-            "return_uri": return_uri
-        })
+        try:
+            data = create_account({
+                "username": username,
+                "password": password,
+                "email": email,
+                "token": token,
+                "return_uri": return_uri
+            })
+        except requests.RequestException as error:
+            print(f"Creating {username} failed ({error}).")
+            data = None
+            if journal is not None:
+                journal.record_result(username, False, str(error))
+        else:
+            if journal is not None:
+                succeeded = isinstance(data, dict) and data.get("createaccount", {}).get("status") == "PASS"
+                journal.record_result(username, succeeded, data)
+
+        results[username] = data
+
+    return results
 
 
-def create_bot_account(option):
-    username = option["username"]
-    password = option["password"]
-    email = option["email"]
+def create_bot_accounts(option):
+    accounts = option["accounts"]
 
     create_account_token = option["create_account_token"]
     user_rights_token = option["user_rights_token"]
     return_uri = option["return_uri"]
 
-    create_account({
-        "username": username,
-        "password": password,
-        "email": email,
-        "token": create_account_token,
-        "return_uri": return_uri
+    return provision_accounts({
+        "accounts": [dict(account, groups="bot") for account in accounts],
+        "create_account_token": create_account_token,
+        "user_rights_token": user_rights_token,
+        "return_uri": return_uri,
+        "workers": option.get("workers", WORKERS),
+        "journal": option.get("journal"),
+        "resume": option.get("resume", False)
     })
 
-    add_user_to_groups({
-        "username": username,
-        "groups": "bot",
-        "token": user_rights_token
-    })
 
+def normalize_username(username):
+    """
+    Normalizes the username the way MediaWiki does: underscores become spaces, runs of spaces are collapsed, and the
+    first letter is capitalized.
+    :param username:
+    :return: Normalized username.
+    :raise ValueError: If MediaWiki would not accept the username.
+    """
+
+    if any(ord(character) < 32 or ord(character) == 127 for character in username):
+        raise ValueError("The username contains control characters.")
+
+    name = " ".join(part for part in username.replace("_", " ").split(" ") if part)
+    if not name:
+        raise ValueError("The username is empty.")
+
+    name = name[0].upper() + name[1:]
+
+    if len(name.encode("utf-8")) > MAX_USERNAME_LENGTH:
+        raise ValueError(f"The username is longer than {MAX_USERNAME_LENGTH} bytes.")
+
+    invalid_characters = sorted(set(name) & INVALID_USERNAME_CHARACTERS)
+    if invalid_characters:
+        raise ValueError(f"The username contains invalid characters: {' '.join(invalid_characters)}")
+
+    if PERCENT_ENCODING_PATTERN.search(name):
+        raise ValueError("The username contains percent-encoded characters.")
+
+    try:
+        ipaddress.ip_address(name)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("The username is an IP address.")
+
+    return name
+
+
+def validate_accounts(accounts):
+    """
+    Normalizes the username of each account and checks the accounts locally, before any request is sent. Accounts
+    that are invalid, or whose normalized username was already seen, get an "error" instead, which starts with the
+    "line" of the account if it has one. Accounts that `read_accounts` could not read already have an "error".
+    :param accounts: Iterable of accounts.
+    :return: Generator of the accounts.
+    """
+
+    seen_usernames = set()
+
+    for row in accounts:
+        username = row.get("username")
+        # Invalid accounts keep their username as it was given, so that they can be reported.
+        account = dict(row, username=("" if username is None else str(username)))
+
+        try:
+            if "error" in row:
+                raise ValueError(row["error"])
+            for field in ACCOUNT_STRING_FIELDS:
+                if row.get(field) is not None and not isinstance(row[field], str):
+                    raise ValueError(f"The {field.replace('_', ' ')} is not a string.")
+            groups = row.get("groups")
+            if not (groups is None or isinstance(groups, str) or (
+                isinstance(groups, list) and all(isinstance(group, str) for group in groups)
+            )):
+                raise ValueError("The groups are not a string or a list of strings.")
+
+            username = normalize_username(account["username"])
+            if not account.get("password"):
+                raise ValueError("The password is empty.")
+            if username in seen_usernames:
+                raise ValueError("The username is a duplicate.")
+        except ValueError as error:
+            account["error"] = (f"Line {account['line']}: {error}" if "line" in account else str(error))
+        else:
+            seen_usernames.add(username)
+            account["username"] = username
+
+        yield account
+
+
+def read_accounts(file, input_format):
+    """
+    Reads accounts one by one from a CSV file with a header row, or from a JSON Lines file. The columns or keys are
+    "username", "password", "email", "real_name" and "groups", where groups are separated by "|" in CSV. Each account
+    gets the "line" it was read from. A JSON line that is not an object gets an "error" instead of failing the import,
+    so that it is reported by `validate_accounts` with the other invalid accounts.
+    :param file: Text file.
+    :param input_format: "csv" or "jsonl".
+    :return: Generator of the accounts.
+    """
+
+    if input_format == "jsonl":
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                account = json.loads(line)
+            except json.JSONDecodeError as error:
+                yield {"line": line_number, "error": f"The line is not valid JSON ({error.msg})."}
+                continue
+            if not isinstance(account, dict):
+                yield {"line": line_number, "error": "The line is not a JSON object."}
+                continue
+            yield dict(account, line=line_number)
+        return
+
+    reader = csv.DictReader(file)
+    for row in reader:
+        account = {key: value for key, value in row.items() if key is not None and value not in (None, "")}
+        # The line the row ends on, which is the line it starts on unless a quoted value spans lines.
+        account["line"] = reader.line_num
+        yield account
+
+
+def provision_account(option):
+    """
+    Creates the account unless it already exists, and then adds it to its missing groups right away.
+    :param option: "account", "exists" flag, "missing_groups" list, "create_account_token", "user_rights_token",
+        "return_uri", and an optional "journal". An account with an "error", set by `validate_accounts`, fails without
+        any request and is not journaled, since its username may belong to another row.
+    :return: Result with the "username", the "status" of the account, the "groups_status" of its missing groups, or
+        None if none were added, and the "detail" of the last response or error.
+    """
+
+    account = option["account"]
+    username = account["username"]
+    missing_groups = option["missing_groups"]
+    journal = option.get("journal")
+
+    if "error" in account:
+        return {"username": username, "status": ACCOUNT_FAILED, "groups_status": None, "detail": account["error"]}
+
+    status = ACCOUNT_EXISTS
+    groups_status = None
+    detail = None
+
+    try:
+        if not option["exists"]:
+            detail = create_account({
+                "username": username,
+                "password": account["password"],
+                "email": account.get("email", ""),
+                "real_name": account.get("real_name", ""),
+                "token": option["create_account_token"],
+                "return_uri": option["return_uri"],
+                "verbose": False
+            })
+            status = (
+                ACCOUNT_CREATED
+                if isinstance(detail, dict) and detail.get("createaccount", {}).get("status") == "PASS"
+                else ACCOUNT_FAILED
+            )
+    except (requests.RequestException, ValueError) as error:
+        status = ACCOUNT_FAILED
+        detail = str(error)
+
+    if missing_groups and status != ACCOUNT_FAILED:
+        try:
+            detail = add_user_to_groups({
+                "username": username,
+                "groups": "|".join(missing_groups),
+                "token": option["user_rights_token"],
+                "verbose": False
+            })
+            groups_status = (ACCOUNT_GROUPED if "userrights" in detail else ACCOUNT_GROUPING_FAILED)
+        except (requests.RequestException, ValueError) as error:
+            groups_status = ACCOUNT_GROUPING_FAILED
+            detail = str(error)
+
+    result = {"username": username, "status": status, "groups_status": groups_status, "detail": detail}
+
+    if journal is not None:
+        journal.record_result(username, not is_result_failed(result), detail)
+
+    return result
+
+
+def is_result_failed(result):
+    return result["status"] == ACCOUNT_FAILED or result["groups_status"] == ACCOUNT_GROUPING_FAILED
+
+
+def get_result_statuses(result):
+    """
+    :param result: Result of `provision_account`.
+    :return: The statuses the result counts towards: the status of the account, and the status of its groups if any
+        were added.
+    """
+
+    if result["groups_status"] is None:
+        return [result["status"]]
+    return [result["status"], result["groups_status"]]
+
+
+def iterate_provisioned_accounts(option):
+    """
+    Creates the accounts and adds them to their groups over a pool of workers. Each worker adds its user to the groups
+    as soon as the account is created, so there is no barrier between the two steps. The accounts are read in batches
+    of "batch_size", and the usernames of each batch are looked up first, so accounts that already exist are only
+    added to the groups they are missing. Only one batch is held in memory at a time.
+    :param option: "accounts" iterable, where each account can have "real_name" and "groups",
+        "create_account_token", "user_rights_token", "return_uri", and optional "workers" count, "batch_size",
+        "journal" and "resume" flag as in `create_accounts`.
+    :return: Generator of the result of each account, as returned by `provision_account`, in the same order as
+        "accounts". Accounts skipped because of "resume" are left out.
+    """
 
-def create_bot_accounts(option):
     accounts = option["accounts"]
 
-    create_account_token = option["create_account_token"]
-    user_rights_token = option["user_rights_token"]
-    return_uri = option["return_uri"]
+    workers = option.get("workers", WORKERS)
+    batch_size = option.get("batch_size", PROVISION_BATCH_SIZE)
+    journal = option.get("journal")
+    resume = option.get("resume", False)
+
+    finished_usernames = (journal.read_finished_keys() if resume and journal is not None else set())
+    skipped = 0
+
+    mount_connection_pool(session, rate_controller, workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in split_iterable_into_batches(accounts, batch_size):
+            if finished_usernames:
+                unfinished_accounts = [account for account in batch if account["username"] not in finished_usernames]
+                skipped += len(batch) - len(unfinished_accounts)
+                batch = unfinished_accounts
+
+            users = fetch_users({
+                "usernames": [account["username"] for account in batch if "error" not in account],
+                "properties": "groups"
+            })
+
+            options = []
+            for account in batch:
+                user = users.get(account["username"], {})
+                exists = bool(user) and "missing" not in user
+                current_groups = user.get("groups", [])
+                options.append({
+                    "account": account,
+                    "exists": exists,
+                    "missing_groups": [
+                        group for group in split_groups(account.get("groups")) if group not in current_groups
+                    ],
+                    "create_account_token": option["create_account_token"],
+                    "user_rights_token": option["user_rights_token"],
+                    "return_uri": option["return_uri"],
+                    "journal": journal
+                })
+
+            yield from executor.map(provision_account, options)
 
-    for account in accounts:
-        username = account["username"]
-        password = account["password"]
-        email = account["email"]
+    if skipped:
+        print(f"Skipped {skipped} account(s) the journal records as done.")
+
+
+def provision_accounts(option):
+    """
+    Provisions the accounts like `iterate_provisioned_accounts`.
+    :param option: As in `iterate_provisioned_accounts`.
+    :return: List of the results, in the same order as "accounts". A username can appear more than once, such as
+        when the input repeats it.
+    """
+
+    return list(iterate_provisioned_accounts(option))
+
+
+def describe_result_detail(detail):
+    if isinstance(detail, dict):
+        error = detail.get("error") or detail.get("createaccount")
+        if isinstance(error, dict):
+            return error.get("info") or error.get("message") or error.get("code") or ""
+        return ""
+    return ("" if detail is None else str(detail))
+
+
+def format_results_table(results):
+    """
+    :param results: Results of `provision_accounts`.
+    :return: Table of the username and status of each account, with the reason of each failure, followed by the
+        number of accounts per status.
+    """
+
+    rows = [("Username", "Status", "Detail")]
+    for result in results:
+        detail = (describe_result_detail(result["detail"]) if is_result_failed(result) else "")
+        rows.append((result["username"], ", ".join(get_result_statuses(result)), detail))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(2)]
+    lines = [f"{username:<{widths[0]}}  {status:<{widths[1]}}  {detail}".rstrip() for username, status, detail in rows]
+
+    lines.append(format_results_summary(Counter(
+        status for result in results for status in get_result_statuses(result)
+    )))
+
+    return "\n".join(lines)
+
+
+def format_results_summary(counts):
+    statuses = (ACCOUNT_CREATED, ACCOUNT_EXISTS, ACCOUNT_FAILED, ACCOUNT_GROUPED, ACCOUNT_GROUPING_FAILED)
+    return ", ".join(f"{status.capitalize()}: {counts[status]}" for status in statuses)
+
+
+def import_accounts(option):
+    """
+    Streams the accounts from a CSV or JSON Lines file, validates them locally and provisions them in batches, so
+    the file is never held in memory. Failures are printed as they happen, followed by the number of accounts per
+    status.
+    :param option: "path" of the file, or "-" for standard input, optional "input_format", which defaults to the file
+        extension, plus the options of `iterate_provisioned_accounts` other than "accounts".
+    :return: Number of accounts per status.
+    """
+
+    path = option["path"]
+    input_format = option.get("input_format") or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+
+    if path == "-":
+        file = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig", newline="")
+    else:
+        file = open(path, encoding="utf-8-sig", newline="")
+
+    counts = Counter()
+
+    with file:
+        accounts = validate_accounts(read_accounts(file, input_format))
+        for result in iterate_provisioned_accounts(dict(option, accounts=accounts)):
+            counts.update(get_result_statuses(result))
+            if is_result_failed(result):
+                print(f"{result['username']}: {describe_result_detail(result['detail'])}")
+
+    print(format_results_summary(counts))
+
+    return counts
+
+
+def create_accounts_asynchronously(option):
+    """
+    Logs in with its own asynchronous client and creates all the accounts at once, with at most "limit" requests in
+    flight. Each bot account is added to the "bot" group right after it is created.
+    :param option: "accounts" and "bot_accounts" lists, plus an optional "limit".
+    :return: The createaccount responses of "accounts", and the (createaccount, userrights) responses of
+        "bot_accounts", both in input order.
+    """
+
+    # Imported here so that the synchronous functions do not require aiohttp.
+    from mediawiki_client import MediaWikiClient
+
+    accounts = option.get("accounts", [])
+    bot_accounts = option.get("bot_accounts", [])
+
+    limit = option.get("limit", LIMIT)
+
+    async def create_account_with(client, account, token):
+        return await client.create_account(
+            account["username"], account["password"], account["email"], WIKI_URI, token
+        )
+
+    async def create_bot_account_with(client, account, create_account_token, user_rights_token):
+        created = await create_account_with(client, account, create_account_token)
+        grouped = await client.change_user_group_membership(account["username"], user_rights_token, add_groups="bot")
+        return created, grouped
 
-        create_bot_account({
-            "username": username,
-            "password": password,
-            "email": email,
-            "create_account_token": create_account_token,
-            "user_rights_token": user_rights_token,
-            "return_uri": return_uri
-        })
+    async def run():
+        async with MediaWikiClient(API_ENDPOINT, limit=limit) as client:
+            print(await client.login(USERNAME, PASSWORD, WIKI_URI))
+
+            tokens = await client.fetch_tokens("createaccount|userrights")
+            create_account_token = tokens["createaccounttoken"]
+            user_rights_token = tokens["userrightstoken"]
+
+            return await asyncio.gather(
+                asyncio.gather(*(
+                    create_account_with(client, account, create_account_token) for account in accounts
+                )),
+                asyncio.gather(*(
+                    create_bot_account_with(client, account, create_account_token, user_rights_token)
+                    for account in bot_accounts
+                ))
+            )
+
+    return asyncio.run(run())
 
 
 def main(*args):
@@ -246,28 +875,52 @@ def main(*args):
         {"username": "InternetArchiveBot", "password": "password", "email": "InternetArchiveBot@domain.tld"}
     ]
 
-    print("Fetching login token...")
-    login_token = fetch_login_token()
-    print()
-
-    print("Logging in...")
-    login({"username": USERNAME, "password": PASSWORD, "token": login_token, "return_uri": WIKI_URI})
-    print()
+    parser = argparse.ArgumentParser(description="Creates the accounts and the bot accounts.")
+    parser.add_argument("--input", help="CSV or JSON Lines file of accounts to create instead, with username, password, email, real_name and groups columns. Groups are separated by |. Use - for standard input.")
+    parser.add_argument("--input-format", help="Input format. Defaults to jsonl for .jsonl files and csv otherwise.", choices=("csv", "jsonl"))
+    parser.add_argument("--workers", help="Number of accounts provisioned at once.", type=int, default=WORKERS)
+    parser.add_argument("--resume", help="Skip the accounts the journal records as done.", action="store_true")
+    parser.add_argument("--metrics-json", help="Write the request metrics to this JSON file.")
+    parser.add_argument("--metrics-prometheus", help="Write the request metrics to this Prometheus textfile collector file, such as requests.prom.")
+    arguments = parser.parse_args(args or None)
 
-    print("Fetching create account token...")
-    create_account_token = fetch_create_account_token()
-    print()
-
-    print("Creating accounts...")
-    create_accounts({"accounts": accounts, "token": create_account_token, "return_uri": WIKI_URI})
-    print()
-
-    print("Fetching user rights token...")
-    user_rights_token = fetch_user_rights_token()
-    print()
-
-    print("Creating bot accounts...")
-    create_bot_accounts({"accounts": bot_accounts, "create_account_token": create_account_token, "user_rights_token": user_rights_token, "return_uri": WIKI_URI})
+    try:
+        print("Logging in...")
+        resume_session_or_login({"username": USERNAME, "password": PASSWORD, "return_uri": WIKI_URI, "session_cache_path": SESSION_CACHE_PATH})
+        print()
+
+        with Journal(JOURNAL_PATH) as journal:
+            print("Fetching create account token...")
+            create_account_token = fetch_create_account_token()
+            print()
+
+            print("Fetching user rights token...")
+            user_rights_token = fetch_user_rights_token()
+            print()
+
+            option = {
+                "create_account_token": create_account_token,
+                "user_rights_token": user_rights_token,
+                "return_uri": WIKI_URI,
+                "workers": arguments.workers,
+                "journal": journal,
+                "resume": arguments.resume
+            }
+
+            if arguments.input:
+                print(f"Importing accounts from {arguments.input}...")
+                import_accounts(dict(option, path=arguments.input, input_format=arguments.input_format))
+                return
+
+            print("Creating accounts and bot accounts...")
+            results = provision_accounts(dict(
+                option,
+                accounts=validate_accounts(accounts + [dict(account, groups="bot") for account in bot_accounts])
+            ))
+            print(format_results_table(results))
+    finally:
+        print()
+        request_metrics.report(arguments.metrics_json, arguments.metrics_prometheus)
 
 
 if __name__ == "__main__":
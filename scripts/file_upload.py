@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from contextlib import closing
+import mmap
+import os
+import time
+
+import requests
+
+CHUNK_SIZE = 5 * 1024 * 1024
+# Number of times a chunk is sent again after its request failed.
+CHUNK_RETRIES = 3
+POLL_INTERVAL = 1
+
+
+def upload_file(post, option):
+    """
+    :param post: Function that posts a request body and files to the API and returns the response.
+    :param option: "name", "data" and "token".
+    :return: The response data, or None if the response is not JSON.
+    """
+
+    file_name = option["name"]
+    file_data = option["data"]
+
+    token = option["token"]
+
+    body = {
+        "action": "upload",
+        "filename": file_name,
+        "token": token,
+        "format": "json",
+        "ignorewarnings": 1
+    }
+
+    files = {
+        "file": (file_name, file_data, "multipart/form-data")
+    }
+
+    response = post(body, files)
+
+    data = None
+
+    try:
+        data = response.json()
+
+        print(data)
+    except ValueError:
+        print(response)
+        print(response.content)
+
+    return data
+
+
+def upload_file_chunk(post, option):
+    file_name = option["name"]
+    file_size = option["size"]
+    chunk = option["chunk"]
+    offset = option["offset"]
+
+    token = option["token"]
+
+    body = {
+        "action": "upload",
+        "stash": 1,
+        "filename": file_name,
+        "filesize": file_size,
+        "offset": offset,
+        "token": token,
+        "format": "json",
+        "ignorewarnings": 1
+    }
+
+    if option.get("filekey"):
+        body["filekey"] = option["filekey"]
+
+    files = {
+        "chunk": (file_name, chunk, "multipart/form-data")
+    }
+
+    response = post(body, files)
+
+    return response.json()
+
+
+def poll_stashed_file(post, option):
+    filekey = option["filekey"]
+
+    token = option["token"]
+
+    body = {
+        "action": "upload",
+        "checkstatus": 1,
+        "filekey": filekey,
+        "token": token,
+        "format": "json"
+    }
+
+    while True:
+        response = post(body)
+        data = response.json()
+
+        if data.get("upload", {}).get("result") != "Poll":
+            return data
+
+        time.sleep(POLL_INTERVAL)
+
+
+def publish_stashed_file(post, option):
+    file_name = option["name"]
+    filekey = option["filekey"]
+
+    token = option["token"]
+
+    body = {
+        "action": "upload",
+        "filename": file_name,
+        "filekey": filekey,
+        "token": token,
+        "format": "json",
+        "ignorewarnings": 1
+    }
+
+    response = post(body)
+
+    data = None
+
+    try:
+        data = response.json()
+
+        print(data)
+    except ValueError:
+        print(response)
+        print(response.content)
+
+    return data
+
+
+def upload_file_in_chunks(post, option, on_retry=None):
+    """
+    https://www.mediawiki.org/wiki/API:Upload#Chunked_uploading
+    The file is memory-mapped, so only the chunk being sent is read into memory. A chunk that fails is sent again from
+    the last offset acknowledged by the wiki. To resume an earlier upload, pass its "filekey" and "offset".
+    :param post: Function that posts a request body and files to the API and returns the response.
+    :param option: "name", "path" and "token", plus optional "chunk_size", "filekey" and "offset".
+    :param on_retry: Function called with the action and the error of a chunk sent again, or None.
+    :return: The response data of the final upload, or of the first chunk the wiki rejected.
+    """
+
+    file_name = option["name"]
+    file_path = option["path"]
+
+    token = option["token"]
+    chunk_size = option.get("chunk_size", CHUNK_SIZE)
+    filekey = option.get("filekey")
+    offset = option.get("offset", 0)
+
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        return upload_file(post, {"name": file_name, "data": b"", "token": token})
+
+    with open(file_path, "rb") as file, closing(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)) as data:
+        failures = 0
+        while offset < file_size:
+            try:
+                result = upload_file_chunk(post, {
+                    "name": file_name,
+                    "size": file_size,
+                    "chunk": data[offset:offset + chunk_size],
+                    "offset": offset,
+                    "filekey": filekey,
+                    "token": token
+                })
+            except (requests.RequestException, ValueError) as error:
+                failures += 1
+                if failures > CHUNK_RETRIES:
+                    raise
+                print(f"Uploading the chunk at offset {offset} of {file_name} failed ({error}). Retrying...")
+                if on_retry is not None:
+                    on_retry("upload", type(error).__name__)
+                continue
+
+            failures = 0
+
+            upload = result.get("upload", {})
+            filekey = upload.get("filekey", filekey)
+            upload_result = upload.get("result")
+
+            if upload_result == "Continue":
+                offset = upload["offset"]
+            elif upload_result == "Poll":
+                result = poll_stashed_file(post, {"filekey": filekey, "token": token})
+                if result.get("upload", {}).get("result") != "Success":
+                    print(result)
+                    return result
+                break
+            elif upload_result == "Success":
+                break
+            else:
+                print(result)
+                return result
+
+    return publish_stashed_file(post, {"name": file_name, "filekey": filekey, "token": token})
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+
+class Journal:
+    """
+    Append-only JSON Lines journal of the final status of each item of a bulk job, such as an account or a file. Every
+    line is flushed as soon as it is written, so the journal survives the job being interrupted. When an item is
+    recorded more than once, its last line wins.
+
+    Usage:
+        with Journal(JOURNAL_PATH) as journal:
+            names = journal.filter_unfinished(names)
+            ...
+            journal.record(name, Journal.DONE, data)
+    """
+
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def record(self, key, status, detail=None):
+        line = json.dumps({
+            "key": key,
+            "status": status,
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "detail": detail
+        }, ensure_ascii=False, default=str)
+
+        with self.lock:
+            self.open()
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def record_result(self, key, succeeded, detail=None):
+        self.record(key, (self.DONE if succeeded else self.FAILED), detail)
+
+    def read_statuses(self):
+        """
+        :return: Dictionary of key to the last status recorded for it.
+        """
+
+        statuses = {}
+        if not os.path.exists(self.path):
+            return statuses
+
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted job.
+                    continue
+                statuses[entry["key"]] = entry["status"]
+
+        return statuses
+
+    def read_finished_keys(self):
+        """
+        :return: Set of the keys whose last status is done.
+        """
+
+        return set(key for key, status in self.read_statuses().items() if status == self.DONE)
+
+    def filter_unfinished(self, keys):
+        """
+        :param keys:
+        :return: The keys that failed or were never recorded as done, in the same order.
+        """
+
+        finished_keys = self.read_finished_keys()
+        return [key for key in keys if key not in finished_keys]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import json
+
+import aiohttp
+
+LIMIT = 100
+
+
+class MediaWikiClient:
+    """
+    Asynchronous MediaWiki API client. Every request waits on a shared semaphore, so any number of coroutines can be
+    scheduled at once while at most `limit` requests are in flight.
+
+    Usage:
+        async with MediaWikiClient(API_ENDPOINT) as client:
+            await client.login(USERNAME, PASSWORD, WIKI_URI)
+            token = await client.fetch_csrf_token()
+            results = await asyncio.gather(*(client.upload_file(name, data, token) for name, data in files))
+    """
+
+    def __init__(self, api_endpoint, limit=LIMIT, verify=False):
+        self.api_endpoint = api_endpoint
+        self.limit = limit
+        self.verify = verify
+
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, ssl=(None if self.verify else False))
+        # The wiki is usually addressed by IP, which the default cookie jar refuses to store cookies for.
+        cookie_jar = aiohttp.CookieJar(unsafe=True)
+        self.session = aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar)
+        self.semaphore = asyncio.Semaphore(self.limit)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method, body, files=None):
+        if files is not None:
+            data = aiohttp.FormData()
+            for key, value in body.items():
+                data.add_field(key, str(value))
+            for key, (file_name, file_data, content_type) in files.items():
+                data.add_field(key, file_data, filename=file_name, content_type=content_type)
+            body = data
+
+        options = ({"params": body} if method == "GET" else {"data": body})
+
+        async with self.semaphore:
+            async with self.session.request(method, self.api_endpoint, **options) as response:
+                text = await response.text()
+
+        try:
+            return json.loads(text)
+        except ValueError:
+            print(response)
+            print(text)
+            return None
+
+    async def get(self, body):
+        return await self.request("GET", body)
+
+    async def post(self, body, files=None):
+        return await self.request("POST", body, files)
+
+    async def fetch_tokens(self, token_type):
+        body = {
+            "action": "query",
+            "meta": "tokens",
+            "type": token_type,
+            "format": "json"
+        }
+
+        data = await self.get(body)
+
+        tokens = data["query"]["tokens"]
+
+        return tokens
+
+    async def fetch_login_token(self):
+        return (await self.fetch_tokens("login"))["logintoken"]
+
+    async def fetch_csrf_token(self):
+        return (await self.fetch_tokens("csrf"))["csrftoken"]
+
+    async def fetch_create_account_token(self):
+        return (await self.fetch_tokens("createaccount"))["createaccounttoken"]
+
+    async def fetch_user_rights_token(self):
+        return (await self.fetch_tokens("userrights"))["userrightstoken"]
+
+    async def login(self, username, password, return_uri, token=None):
+        if not isinstance(token, str):
+            token = await self.fetch_login_token()
+
+        body = {
+            "action": "clientlogin",
+            "username": username,
+            "password": password,
+            "loginreturnurl": return_uri,
+            "logintoken": token,
+            "format": "json"
+        }
+
+        return await self.post(body)
+
+    async def create_account(self, username, password, email, return_uri, token, real_name=""):
+        body = {
+            "action": "createaccount",
+            "username": username,
+            "password": password,
+            "retype": password,
+            "email": email,
+            "realname": real_name,
+            "createreturnurl": return_uri,
+            "createtoken": token,
+            "format": "json"
+        }
+
+        return await self.post(body)
+
+    async def change_user_group_membership(self, username, token, add_groups=None, remove_groups=None):
+        body = {
+            "action": "userrights",
+            "user": username,
+            "token": token,
+            "format": "json"
+        }
+
+        if add_groups is not None:
+            body["add"] = add_groups
+
+        if remove_groups is not None:
+            body["remove"] = remove_groups
+
+        return await self.post(body)
+
+    async def upload_file(self, file_name, file_data, token):
+        body = {
+            "action": "upload",
+            "filename": file_name,
+            "token": token,
+            "format": "json",
+            "ignorewarnings": 1
+        }
+
+        files = {
+            "file": (file_name, file_data, "multipart/form-data")
+        }
+
+        return await self.post(body, files)
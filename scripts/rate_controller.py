@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+MAXLAG = 5
+# Seconds to wait after a throttle signal that does not say how long to wait.
+THROTTLE_DELAY = 5
+
+# Error codes of requests that the wiki refused because it is lagged or the user is sending too many requests.
+THROTTLE_ERROR_CODES = ("maxlag", "ratelimited")
+THROTTLE_STATUS_CODES = (429, 503)
+
+# Responses worth sending the request again for, after a backoff.
+TRANSIENT_STATUS_CODES = (500, 502, 504)
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+
+# Number of times a write is sent again after the wiki asked to slow down or a transient error.
+RETRIES = 5
+
+
+def split_into_batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def mount_connection_pool(session, rate_controller, size):
+    """
+    Gives the session a connection pool for `size` workers, and caps the rate controller's limit to match.
+    :param session: requests.Session
+    :param rate_controller: RateController shared by the workers.
+    :param size: Number of workers.
+    :return:
+    """
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    rate_controller.set_max_limit(size)
+
+
+def get_backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Exponential backoff with full jitter, so that workers that failed together do not retry together.
+    :param attempt: Number of attempts that have failed so far, minus one.
+    :param base:
+    :param cap:
+    :return: Seconds to wait.
+    """
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_throttle_delay(response, default_delay=THROTTLE_DELAY):
+    """
+    :param response: API response.
+    :param default_delay: Seconds to wait if the response has no usable Retry-After header.
+    :return: Seconds to wait before sending the request again if the wiki asked to slow down, or None.
+    """
+
+    try:
+        data = response.json()
+        error_code = (data.get("error", {}).get("code") if isinstance(data, dict) else None)
+    except ValueError:
+        error_code = None
+
+    if error_code not in THROTTLE_ERROR_CODES and response.status_code not in THROTTLE_STATUS_CODES:
+        return None
+
+    try:
+        return max(0.0, float(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return default_delay
+
+
+class RateController:
+    """
+    Additive increase, multiplicative decrease (AIMD) limit on the number of requests in flight, shared by the threads
+    of a bulk job. Every request that goes through raises the limit by 1/limit, which adds about one request per round,
+    up to `max_limit`. A throttle signal halves the limit and pauses every request for the delay the wiki asked for.
+
+    Usage:
+        with rate_controller:
+            response = session.post(url=API_ENDPOINT, data=body)
+        delay = get_throttle_delay(response)
+        if delay is None:
+            rate_controller.on_success()
+        else:
+            rate_controller.on_throttle(delay)
+    """
+
+    def __init__(self, max_limit, min_limit=1, limit=None):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(limit if limit is not None else max_limit)
+
+        self.in_flight = 0
+        self.resume_time = 0.0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def set_max_limit(self, max_limit):
+        with self.condition:
+            self.max_limit = max_limit
+            self.limit = min(self.limit, max_limit)
+            self.condition.notify_all()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                delay = self.resume_time - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def on_throttle(self, delay):
+        with self.condition:
+            now = time.monotonic()
+            # Requests that were in flight together report the same signal, so the limit is halved once per pause.
+            if now >= self.resume_time:
+                self.limit = max(self.min_limit, self.limit / 2)
+                print(f"The wiki asked to slow down. Waiting {delay:g} s and sending at most {int(self.limit)} requests at once...")
+            self.resume_time = max(self.resume_time, now + delay)
+
+
+def post_with_rate_control(session, url, body, rate_controller, files=None, retries=RETRIES, on_retry=None):
+    """
+    Posts a write to the API with `maxlag`, through the rate controller. A request the wiki asks to slow down is sent
+    again once the pause it asked for is over. A request that fails with a network error or a transient server error
+    is sent again after an exponential backoff. Either way, a request is sent at most `retries` more times.
+    :param session: requests.Session
+    :param url: API endpoint.
+    :param body:
+    :param rate_controller: RateController shared by the threads of the job.
+    :param files:
+    :param retries:
+    :param on_retry: Function called with the action and the reason of a request sent again, or None.
+    :return: Response.
+    """
+
+    def retry(reason):
+        if on_retry is not None:
+            on_retry(body["action"], reason)
+
+    body = dict(body)
+    body["maxlag"] = MAXLAG
+
+    for attempt in range(retries + 1):
+        try:
+            with rate_controller:
+                response = session.post(url=url, files=files, data=body)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if attempt == retries:
+                raise
+            delay = get_backoff_delay(attempt)
+            print(f"The request failed ({error}). Retrying in {delay:.1f} s...")
+            retry(type(error).__name__)
+            time.sleep(delay)
+            continue
+
+        delay = get_throttle_delay(response)
+        if delay is not None:
+            rate_controller.on_throttle(delay)
+            retry("throttled")
+            continue
+
+        # The limit is only raised by a request that went through, not by the last of the transient errors.
+        if response.status_code in TRANSIENT_STATUS_CODES:
+            if attempt == retries:
+                break
+            delay = get_backoff_delay(attempt)
+            print(f"The wiki returned HTTP {response.status_code}. Retrying in {delay:.1f} s...")
+            retry(f"http-{response.status_code}")
+            time.sleep(delay)
+            continue
+
+        rate_controller.on_success()
+        break
+
+    return response
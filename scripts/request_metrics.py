@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+import json
+import math
+import os
+import re
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+METRIC_PREFIX = "mediawiki_api"
+
+MULTIPART_ACTION_PATTERN = re.compile(rb'name="action"\r\n\r\n([^\r]*)')
+
+
+def get_request_action(request):
+    """
+    :param request: requests.PreparedRequest
+    :return: The API action of the request, such as "upload", or the page title or path for non-API requests.
+    """
+
+    url = urlsplit(request.url)
+    params = parse_qs(url.query)
+
+    body = request.body
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if isinstance(body, bytes):
+        content_type = request.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            match = MULTIPART_ACTION_PATTERN.search(body)
+            if match:
+                params.setdefault("action", [match.group(1).decode("utf-8", "replace")])
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            for key, values in parse_qs(body.decode("utf-8", "replace")).items():
+                params.setdefault(key, values)
+
+    for key in ("action", "title"):
+        if params.get(key):
+            return params[key][0]
+
+    return url.path.rsplit("/", 1)[-1]
+
+
+class ActionMetrics:
+    def __init__(self):
+        self.count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = Counter()
+        self.retries = Counter()
+
+    def observe(self, latency):
+        self.count += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+                break
+
+    def estimate_quantile(self, quantile):
+        """
+        :param quantile:
+        :return: Upper bound of the histogram bucket that holds the quantile, or the maximum latency if that is lower.
+        """
+
+        if not self.count:
+            return 0.0
+
+        rank = quantile * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.latency_max)
+
+        return self.latency_max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "latency_sum": self.latency_sum,
+            "latency_max": self.latency_max,
+            "latency_buckets": {str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.buckets)},
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "errors": dict(self.errors),
+            "retries": dict(self.retries)
+        }
+
+
+class RequestMetrics:
+    """
+    Records the latency, the bytes sent and received, the error codes and the retries of every request sent by a
+    requests.Session, per API action. The session's response hook does the recording, so no call site changes.
+
+    Usage:
+        request_metrics = RequestMetrics()
+        request_metrics.install(session)
+        ...
+        print(request_metrics.format_summary())
+        request_metrics.write_prometheus_textfile(path)
+    """
+
+    def __init__(self):
+        self.actions = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def install(self, session):
+        session.hooks["response"].append(self.on_response)
+
+    def get_action_metrics(self, action):
+        action_metrics = self.actions.get(action)
+        if action_metrics is None:
+            action_metrics = self.actions.setdefault(action, ActionMetrics())
+        return action_metrics
+
+    def on_response(self, response, **kwargs):
+        latency = response.elapsed.total_seconds()
+
+        # Unless the response is streamed, read the body now, so that the latency includes downloading it. A streamed
+        # body is counted as it is read, since a chunked response has no Content-Length.
+        if kwargs.get("stream"):
+            bytes_received = 0
+        else:
+            start = time.perf_counter()
+            bytes_received = len(response.content)
+            latency += time.perf_counter() - start
+
+        request = response.request
+        body = request.body
+        bytes_sent = (len(body) if isinstance(body, (bytes, str)) else 0)
+
+        error_code = None
+        if response.status_code >= 400:
+            error_code = f"http-{response.status_code}"
+        elif not kwargs.get("stream") and "json" in response.headers.get("Content-Type", ""):
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and isinstance(data.get("error"), dict):
+                error_code = data["error"].get("code")
+
+        action = get_request_action(request)
+
+        with self.lock:
+            action_metrics = self.get_action_metrics(action)
+            action_metrics.observe(latency)
+            action_metrics.bytes_sent += bytes_sent
+            action_metrics.bytes_received += bytes_received
+            if error_code is not None:
+                action_metrics.errors[error_code] += 1
+
+        if kwargs.get("stream"):
+            self.count_streamed_bytes(response, action)
+
+        return response
+
+    def count_streamed_bytes(self, response, action):
+        """
+        Adds the bytes of the body of a streamed response to the action as they are read. `iter_content` is wrapped,
+        since `content`, `text` and `iter_lines` read the body through it too.
+        :param response: Streamed requests.Response
+        :param action:
+        :return:
+        """
+
+        iter_content = response.iter_content
+
+        def iter_content_and_count(*args, **kwargs):
+            for chunk in iter_content(*args, **kwargs):
+                with self.lock:
+                    self.get_action_metrics(action).bytes_received += len(chunk)
+                yield chunk
+
+        response.iter_content = iter_content_and_count
+
+    def record_retry(self, action, reason):
+        with self.lock:
+            self.get_action_metrics(action).retries[reason] += 1
+
+    def format_summary(self):
+        """
+        :return: Table of the number of requests, errors and retries, the latency and the bytes of each action.
+        """
+
+        rows = [("Action", "Requests", "Errors", "Retries", "Mean s", "p50 s", "p95 s", "Max s", "Sent KiB", "Received KiB")]
+        with self.lock:
+            for action, metrics in sorted(self.actions.items()):
+                rows.append((
+                    action,
+                    str(metrics.count),
+                    str(sum(metrics.errors.values())),
+                    str(sum(metrics.retries.values())),
+                    f"{(metrics.latency_sum / metrics.count if metrics.count else 0):.3f}",
+                    f"{metrics.estimate_quantile(0.5):.3f}",
+                    f"{metrics.estimate_quantile(0.95):.3f}",
+                    f"{metrics.latency_max:.3f}",
+                    f"{metrics.bytes_sent / 1024:.1f}",
+                    f"{metrics.bytes_received / 1024:.1f}"
+                ))
+            errors = sorted(
+                (action, code, count)
+                for action, metrics in self.actions.items()
+                for code, count in metrics.errors.items()
+            )
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = [
+            "  ".join((value.ljust(width) if i == 0 else value.rjust(width)) for i, (value, width) in enumerate(zip(row, widths)))
+            for row in rows
+        ]
+        lines.extend(f"{action}: {count} x {code}" for action, code, count in errors)
+
+        return "\n".join(lines)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "finished": time.time(),
+                "actions": {action: metrics.to_dict() for action, metrics in self.actions.items()}
+            }
+
+    def write_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def format_prometheus(self):
+        """
+        :return: The metrics in the Prometheus text exposition format.
+        """
+
+        def labels(**values):
+            escaped = (
+                key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                for key, value in values.items()
+            )
+            return "{" + ",".join(escaped) + "}"
+
+        prefix = METRIC_PREFIX
+        lines = [
+            f"# HELP {prefix}_request_duration_seconds Latency of the API requests.",
+            f"# TYPE {prefix}_request_duration_seconds histogram"
+        ]
+        with self.lock:
+            actions = sorted(self.actions.items())
+            for action, metrics in actions:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                    cumulative += count
+                    le = ("+Inf" if bound == math.inf else repr(float(bound)))
+                    lines.append(f"{prefix}_request_duration_seconds_bucket{labels(action=action, le=le)} {cumulative}")
+                lines.append(f"{prefix}_request_duration_seconds_sum{labels(action=action)} {metrics.latency_sum}")
+                lines.append(f"{prefix}_request_duration_seconds_count{labels(action=action)} {metrics.count}")
+
+            for name, attribute, help_text in (
+                ("request_bytes_sent_total", "bytes_sent", "Bytes sent in API request bodies."),
+                ("request_bytes_received_total", "bytes_received", "Bytes received in API response bodies.")
+            ):
+                lines.append(f"# HELP {prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {prefix}_{name} counter")
+                for action, metrics in actions:
+                    lines.append(f"{prefix}_{name}{labels(action=action)} {getattr(metrics, attribute)}")
+
+            lines.append(f"# HELP {prefix}_errors_total API errors and HTTP error statuses.")
+            lines.append(f"# TYPE {prefix}_errors_total counter")
+            for action, metrics in actions:
+                for code, count in sorted(metrics.errors.items()):
+                    lines.append(f"{prefix}_errors_total{labels(action=action, code=code)} {count}")
+
+            lines.append(f"# HELP {prefix}_retries_total Requests sent again.")
+            lines.append(f"# TYPE {prefix}_retries_total counter")
+            for action, metrics in actions:
+                for reason, count in sorted(metrics.retries.items()):
+                    lines.append(f"{prefix}_retries_total{labels(action=action, reason=reason)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, path):
+        """
+        Writes the metrics for the node exporter's textfile collector, through a temporary file, so that the collector
+        never reads a partial file.
+        :param path: Path of a .prom file.
+        :return:
+        """
+
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(self.format_prometheus())
+        os.replace(temporary_path, path)
+
+    def report(self, json_path=None, prometheus_path=None):
+        """
+        Prints the summary and writes the metrics to the files given.
+        :param json_path:
+        :param prometheus_path:
+        :return:
+        """
+
+        print("Requests:")
+        print(self.format_summary())
+
+        if json_path:
+            self.write_json(json_path)
+            print(f"Wrote the request metrics to {json_path}.")
+        if prometheus_path:
+            self.write_prometheus_textfile(prometheus_path)
+            print(f"Wrote the request metrics to {prometheus_path}.")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import os
+import threading
+
+import requests
+
+# Error codes of requests that failed because the token or the session has expired.
+SESSION_ERROR_CODES = ("badtoken", "assertuserfailed", "assertnameduserfailed")
+# CSRF token of logged out users.
+ANONYMOUS_CSRF_TOKEN = "+\\"
+
+
+def fetch_user_info(session, api_endpoint):
+    body = {
+        "action": "query",
+        "meta": "userinfo",
+        "format": "json"
+    }
+
+    response = session.get(url=api_endpoint, params=body)
+    data = response.json()
+
+    return data["query"]["userinfo"]
+
+
+def is_logged_in(session, api_endpoint, username):
+    user_info = fetch_user_info(session, api_endpoint)
+    return "anon" not in user_info and user_info.get("name") == username
+
+
+def save_session(session, path, api_endpoint, username, csrf_token=None):
+    """
+    Saves the session cookies and the CSRF token to the session cache file, which only the current user can read.
+    :param session: requests.Session
+    :param path:
+    :param api_endpoint:
+    :param username:
+    :param csrf_token:
+    :return:
+    """
+
+    if not path:
+        return
+
+    cookies = [
+        {
+            "name": cookie.name,
+            "value": cookie.value,
+            "domain": cookie.domain,
+            "path": cookie.path,
+            "secure": cookie.secure,
+            "expires": cookie.expires,
+            "rest": cookie._rest
+        }
+        for cookie in session.cookies
+    ]
+    session_cache = {
+        "api_endpoint": api_endpoint,
+        "username": username,
+        "cookies": cookies,
+        "csrf_token": csrf_token
+    }
+
+    # Create the file without group and other permissions, and remove them if the file already existed.
+    file_descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(file_descriptor, "w") as file:
+        os.chmod(path, 0o600)
+        json.dump(session_cache, file)
+
+
+def load_session(session, path, api_endpoint, username):
+    """
+    Loads the session cookies from the session cache file into the session.
+    :param session: requests.Session
+    :param path:
+    :param api_endpoint:
+    :param username:
+    :return: Session cache, or None if there is no cached session for this wiki and user.
+    """
+
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as file:
+            session_cache = json.load(file)
+    except ValueError:
+        return None
+
+    if session_cache.get("api_endpoint") != api_endpoint or session_cache.get("username") != username:
+        return None
+
+    for cookie in session_cache.get("cookies", []):
+        session.cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+
+    return session_cache
+
+
+def get_session_error_code(response):
+    """
+    :param response: API response.
+    :return: Error code if the request failed because the token or the session has expired, or None.
+    """
+
+    try:
+        data = response.json()
+    except ValueError:
+        return None
+
+    error = (data.get("error") if isinstance(data, dict) else None)
+    error_code = (error.get("code") if isinstance(error, dict) else None)
+
+    return (error_code if error_code in SESSION_ERROR_CODES else None)
+
+
+class SessionRefresher:
+    """
+    Logs a requests.Session in to the wiki, or resumes the cached session if the wiki still accepts it, and logs in
+    again when the token or the session expires. It is shared by the threads of a bulk job: when several requests find
+    the session expired at once, only one of them logs in again, and every later request uses the tokens of the new
+    session.
+
+    Usage:
+        session_refresher = SessionRefresher(session, login, fetch_tokens)
+        session_refresher.resume_session_or_login(API_ENDPOINT, option)
+        ...
+        response = session_refresher.post_with_token(post, body, "csrf")
+    """
+
+    def __init__(self, session, login, fetch_tokens, on_retry=None):
+        """
+        :param session: requests.Session
+        :param login: Function that logs the session in with a login option and returns the `clientlogin` response.
+        :param fetch_tokens: Function that returns the tokens of a token type, such as {"csrftoken": ...}.
+        :param on_retry: Function called with the action and the error code of a request sent again, or None.
+        """
+
+        self.session = session
+        self.login = login
+        self.fetch_tokens = fetch_tokens
+        self.on_retry = on_retry
+
+        self.api_endpoint = None
+        # Whether the session was resumed or the last login succeeded.
+        self.logged_in = False
+        # Login option of the current session, kept to log in again when the session expires.
+        self.login_option = None
+        # Number of times the session has been refreshed, and the tokens fetched since the last time.
+        self.generation = 0
+        self.refreshed_tokens = {}
+        self.lock = threading.Lock()
+
+    def log_in(self):
+        option = self.login_option
+        data = self.login({
+            "username": option["username"],
+            "password": option["password"],
+            "token": self.fetch_tokens("login")["logintoken"],
+            "return_uri": option["return_uri"]
+        })
+        self.logged_in = (isinstance(data, dict) and data.get("clientlogin", {}).get("status") == "PASS")
+        return data
+
+    def save_session(self, csrf_token=None):
+        """
+        Caches the session, unless the last login failed, so that the next run does not try to resume a dead session.
+        :param csrf_token: CSRF token to cache with the session. The token of logged out users is not cached.
+        :return:
+        """
+
+        if not self.logged_in:
+            return
+
+        if csrf_token == ANONYMOUS_CSRF_TOKEN:
+            csrf_token = None
+
+        option = self.login_option
+        save_session(self.session, option["session_cache_path"], self.api_endpoint, option["username"], csrf_token)
+
+    def resume_session_or_login(self, api_endpoint, option):
+        """
+        Resumes the session cached at `session_cache_path` if the wiki still accepts it, which only takes a
+        `meta=userinfo` query. Otherwise, logs in and caches the new session.
+        :param api_endpoint:
+        :param option: Login option with "username", "password", "return_uri" and "session_cache_path".
+        :return: Session cache if the cached session was resumed, or None.
+        """
+
+        username = option["username"]
+        self.api_endpoint = api_endpoint
+        self.login_option = option
+
+        session_cache = load_session(self.session, option["session_cache_path"], api_endpoint, username)
+        if session_cache is not None:
+            if is_logged_in(self.session, api_endpoint, username):
+                print("Resumed cached session.")
+                self.logged_in = True
+                return session_cache
+            self.session.cookies.clear()
+
+        self.log_in()
+        self.save_session()
+
+        return None
+
+    def fetch_refreshed_token(self, token_type):
+        """
+        :param token_type:
+        :return: Token of `token_type` for the session started by the last `refresh_session`.
+        """
+
+        with self.lock:
+            token = self.refreshed_tokens.get(token_type)
+            if token is None:
+                token = self.fetch_tokens(token_type)[token_type + "token"]
+                self.refreshed_tokens[token_type] = token
+            return token
+
+    def refresh_session(self, generation):
+        """
+        Logs in again and caches the new session, unless another thread already did since `generation`.
+        :param generation: Value of `generation` when the failed request was sent.
+        :return:
+        """
+
+        with self.lock:
+            if self.generation != generation:
+                return
+
+            self.session.cookies.clear()
+            self.log_in()
+            self.save_session()
+
+            self.refreshed_tokens.clear()
+            self.generation += 1
+
+    def post_with_token(self, post, body, token_type, token_field="token", files=None):
+        """
+        Posts to the API as a logged in user. If the wiki rejects the token or the session has expired, logs in again,
+        refreshes the token and retries the request once. Once the session has been refreshed, every later request
+        uses the refreshed tokens instead of the ones it was given.
+        :param post: Function that posts a request body and files to the API and returns the response.
+        :param body: Request body with a token.
+        :param token_type: Token type, such as "csrf".
+        :param token_field: Name of the token parameter in the body.
+        :param files:
+        :return: Response.
+        """
+
+        body = dict(body)
+        body["assert"] = "user"
+
+        generation = self.generation
+        if generation:
+            body[token_field] = self.fetch_refreshed_token(token_type)
+
+        response = post(body, files)
+
+        error_code = get_session_error_code(response)
+        if error_code is None or self.login_option is None:
+            return response
+
+        print(f"The wiki returned {error_code}. Logging in again...")
+        if self.on_retry is not None:
+            self.on_retry(body["action"], error_code)
+        self.refresh_session(generation)
+        body[token_field] = self.fetch_refreshed_token(token_type)
+
+        return post(body, files)
@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+import argparse
+import csv
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import uuid
+
+from synthetic_users import NULL_RATIO, SEED, UNICODE_RATIO, generate_users
+
+HOST = "127.0.0.1"
+PORT = 8080
+USERS = 1000
+# Seconds each request waits before it is answered.
+LATENCY = 0.0
+
+SESSION_COOKIE = "stubwiki_session"
+# MediaWiki CSRF tokens end with "+\", which catches clients that do not encode them.
+TOKEN = "0123456789abcdef+\\"
+TOKEN_TYPES = ("createaccount", "csrf", "login", "userrights")
+
+USER_EXPORT_FIELDS = ("user_name", "user_real_name", "user_email", "user_registration")
+USER_EXPORT_BATCH_SIZE = 1000
+
+FILE_NAMESPACE = 6
+
+BOUNDARY_PATTERN = re.compile(r'boundary="?([^";]+)"?')
+CONTENT_DISPOSITION_PATTERN = re.compile(rb'(\w+)="([^"]*)"')
+
+
+def normalize_title(title):
+    """
+    :param title:
+    :return: The title as MediaWiki stores it, with spaces instead of underscores and an uppercase first letter.
+    """
+
+    title = title.replace("_", " ").strip()
+    return title[:1].upper() + title[1:]
+
+
+def parse_multipart(body, content_type):
+    """
+    :param body: Request body.
+    :param content_type: Content-Type header with the boundary.
+    :return: Dictionary of field name to value, and dictionary of file field name to file data.
+    """
+
+    match = BOUNDARY_PATTERN.search(content_type)
+    if match is None:
+        return {}, {}
+    delimiter = b"--" + match.group(1).encode("ascii")
+
+    fields = {}
+    files = {}
+    for part in body.split(delimiter)[1:]:
+        if part.startswith(b"--"):
+            break
+        headers, _, value = part[2:].partition(b"\r\n\r\n")
+        value = value[:-2]
+        parameters = dict(CONTENT_DISPOSITION_PATTERN.findall(headers))
+        name = parameters.get(b"name", b"").decode("utf-8")
+        if b"filename" in parameters:
+            files[name] = value
+        else:
+            fields[name] = value.decode("utf-8")
+
+    return fields, files
+
+
+class StubWiki:
+    """
+    Local stand-in for the MediaWiki API and the UserExport extension, for benchmarking the scripts offline. It answers
+    `meta=tokens`, `meta=userinfo`, `list=users`, `prop=imageinfo`, `clientlogin`, `createaccount`, `userrights`,
+    `upload`, including chunked uploads, and streams the synthetic users as the Special:Userexport CSV. Accounts and
+    files are kept in memory. Any username and password can log in.
+
+    Usage:
+        with StubWiki(users=100000, latency=0.01) as stub_wiki:
+            create_accounts.API_ENDPOINT = stub_wiki.api_endpoint
+            ...
+    """
+
+    def __init__(
+        self,
+        host=HOST,
+        port=0,
+        users=USERS,
+        latency=LATENCY,
+        seed=SEED,
+        unicode_ratio=UNICODE_RATIO,
+        null_ratio=NULL_RATIO
+    ):
+        self.users = users
+        self.latency = latency
+        self.seed = seed
+        self.unicode_ratio = unicode_ratio
+        self.null_ratio = null_ratio
+
+        self.accounts = {}
+        self.files = {}
+        self.stash = {}
+        self.sessions = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), StubWikiRequestHandler)
+        self.server.daemon_threads = True
+        self.server.stub_wiki = self
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def uri(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_endpoint(self):
+        return self.uri + "/api.php"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def iterate_user_export_chunks(self):
+        """
+        :return: Generator of chunks of the Special:Userexport CSV, in which missing values are empty.
+        """
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\r\n")
+        writer.writerow(USER_EXPORT_FIELDS)
+
+        users = generate_users(self.users, self.seed, self.unicode_ratio, self.null_ratio)
+        for i, user in enumerate(users, 1):
+            writer.writerow([user[field] for field in USER_EXPORT_FIELDS])
+            if i % USER_EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue().encode("utf-8")
+
+    def query(self, params, logged_in):
+        query = {}
+
+        if params.get("meta") == "tokens":
+            token_types = params.get("type", "csrf").split("|")
+            query["tokens"] = {f"{token_type}token": TOKEN for token_type in token_types if token_type in TOKEN_TYPES}
+
+        if params.get("meta") == "userinfo":
+            if logged_in:
+                user_info = {"id": 1, "name": "Admin"}
+                if "rights" in params.get("uiprop", ""):
+                    user_info["rights"] = ["createaccount", "userrights", "upload", "apihighlimits"]
+            else:
+                user_info = {"id": 0, "name": "127.0.0.1", "anon": ""}
+            query["userinfo"] = user_info
+
+        if params.get("list") == "users":
+            query["normalized"] = []
+            query["users"] = []
+            with self.lock:
+                for name in params.get("ususers", "").split("|"):
+                    normalized_name = normalize_title(name)
+                    if normalized_name != name:
+                        query["normalized"].append({"from": name, "to": normalized_name})
+                    account = self.accounts.get(normalized_name)
+                    if account is None:
+                        query["users"].append({"name": normalized_name, "missing": ""})
+                        continue
+                    user = {"userid": account["userid"], "name": normalized_name}
+                    if "groups" in params.get("usprop", ""):
+                        user["groups"] = ["*", "user"] + sorted(account["groups"])
+                    query["users"].append(user)
+
+        if params.get("prop") == "imageinfo":
+            query["normalized"] = []
+            query["pages"] = {}
+            with self.lock:
+                for i, title in enumerate(params.get("titles", "").split("|"), 1):
+                    normalized_title = normalize_title(title)
+                    if normalized_title != title:
+                        query["normalized"].append({"from": title, "to": normalized_title})
+                    sha1 = self.files.get(normalized_title.split(":", 1)[-1])
+                    if sha1 is None:
+                        query["pages"][str(-i)] = {"ns": FILE_NAMESPACE, "title": normalized_title, "missing": ""}
+                    else:
+                        query["pages"][str(i)] = {
+                            "pageid": i, "ns": FILE_NAMESPACE, "title": normalized_title, "imageinfo": [{"sha1": sha1}]
+                        }
+
+        return {"batchcomplete": "", "query": query}
+
+    def create_account(self, params):
+        username = normalize_title(params.get("username", ""))
+        with self.lock:
+            if username in self.accounts:
+                return {"createaccount": {
+                    "status": "FAIL",
+                    "message": "Username entered already in use. Please choose a different name.",
+                    "messagecode": "userexists"
+                }}
+            self.accounts[username] = {"userid": len(self.accounts) + 2, "groups": set()}
+
+        return {"createaccount": {"status": "PASS", "username": username}}
+
+    def change_user_rights(self, params):
+        username = normalize_title(params.get("user", ""))
+        add_groups = [group for group in params.get("add", "").split("|") if group]
+        remove_groups = [group for group in params.get("remove", "").split("|") if group]
+
+        with self.lock:
+            account = self.accounts.get(username)
+            if account is None:
+                return {"error": {"code": "nosuchuser", "info": f"The user \"{username}\" does not exist."}}
+            added = [group for group in add_groups if group not in account["groups"]]
+            removed = [group for group in remove_groups if group in account["groups"]]
+            account["groups"].update(added)
+            account["groups"].difference_update(removed)
+
+        return {"userrights": {"user": username, "userid": account["userid"], "added": added, "removed": removed}}
+
+    def publish_file(self, file_name, data):
+        file_name = normalize_title(file_name)
+        with self.lock:
+            self.files[file_name] = hashlib.sha1(data).hexdigest()
+
+        return {"upload": {
+            "result": "Success",
+            "filename": file_name,
+            "imageinfo": {"descriptionurl": f"{self.uri}/index.php/File:{file_name.replace(' ', '_')}"}
+        }}
+
+    def upload(self, params, files):
+        if "chunk" in files:
+            filekey = params.get("filekey") or uuid.uuid4().hex
+            offset = int(params.get("offset", 0))
+            with self.lock:
+                data = self.stash.setdefault(filekey, bytearray())
+                if offset != len(data):
+                    return {"error": {"code": "stashfailed", "info": f"Expected the chunk at offset {len(data)}."}}
+                data += files["chunk"]
+                size = len(data)
+            if size < int(params.get("filesize", 0)):
+                return {"upload": {"result": "Continue", "filekey": filekey, "offset": size}}
+            return {"upload": {"result": "Success", "filekey": filekey}}
+
+        if "filekey" in params:
+            filekey = params["filekey"]
+            with self.lock:
+                data = self.stash.get(filekey)
+            if data is None:
+                return {"error": {"code": "stashnosuchfilekey", "info": f"No such filekey: {filekey}."}}
+            if params.get("checkstatus"):
+                return {"upload": {"result": "Success", "filekey": filekey}}
+            with self.lock:
+                del self.stash[filekey]
+            return self.publish_file(params.get("filename", ""), bytes(data))
+
+        if "file" in files:
+            return self.publish_file(params.get("filename", ""), files["file"])
+
+        return {"error": {"code": "missingparam", "info": "One of the parameters filekey, file or url is required."}}
+
+    def handle_api_request(self, params, files, logged_in):
+        """
+        :param params:
+        :param files:
+        :param logged_in:
+        :return: Response data and the new session ID if the request logged in, or None.
+        """
+
+        action = params.get("action")
+        if params.get("assert") == "user" and not logged_in:
+            return {"error": {"code": "assertuserfailed", "info": "You are no longer logged in."}}, None
+
+        if action == "query":
+            return self.query(params, logged_in), None
+        if action == "clientlogin":
+            session_id = uuid.uuid4().hex
+            with self.lock:
+                self.sessions.add(session_id)
+            return {"clientlogin": {"status": "PASS", "username": params.get("username")}}, session_id
+        if action == "createaccount":
+            return self.create_account(params), None
+        if action == "userrights":
+            return self.change_user_rights(params), None
+        if action == "upload":
+            return self.upload(params, files), None
+
+        return {"error": {"code": "badvalue", "info": f"Unrecognized value for parameter \"action\": {action}."}}, None
+
+
+class StubWikiRequestHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests, like the wiki's web server.
+    protocol_version = "HTTP/1.1"
+    # Sends the headers and the body of a response together, so that small responses are not held back by Nagle's
+    # algorithm waiting on the client's delayed ACK.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_params(self):
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        files = {}
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            fields, files = parse_multipart(body, content_type)
+            params.update(fields)
+        elif body:
+            params.update((key, values[0]) for key, values in parse_qs(body.decode("utf-8")).items())
+
+        return url.path, params, files
+
+    def is_logged_in(self):
+        stub_wiki = self.server.stub_wiki
+        for cookie in self.headers.get("Cookie", "").split(";"):
+            name, _, value = cookie.strip().partition("=")
+            if name == SESSION_COOKIE and value in stub_wiki.sessions:
+                return True
+        return False
+
+    def send_json(self, data, session_id=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if session_id is not None:
+            self.send_header("Set-Cookie", f"{SESSION_COOKIE}={session_id}; Path=/; HttpOnly")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_user_export(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in self.server.stub_wiki.iterate_user_export_chunks():
+            if chunk:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def handle_request(self):
+        stub_wiki = self.server.stub_wiki
+        path, params, files = self.read_params()
+
+        with stub_wiki.lock:
+            stub_wiki.requests += 1
+        if stub_wiki.latency:
+            time.sleep(stub_wiki.latency)
+
+        title = normalize_title(unquote(params.get("title") or path.rsplit("/", 1)[-1]))
+        if title.lower() == "special:userexport":
+            self.send_user_export()
+            return
+
+        if not path.endswith("/api.php"):
+            self.send_error(404)
+            return
+
+        data, session_id = stub_wiki.handle_api_request(params, files, self.is_logged_in())
+        self.send_json(data, session_id)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description="Serves a stub MediaWiki API and Special:Userexport page for benchmarks.")
+    parser.add_argument("--host", help="Host to listen on.", default=HOST)
+    parser.add_argument("--port", help="Port to listen on.", type=int, default=PORT)
+    parser.add_argument("--users", help="Number of users in the Special:Userexport CSV.", type=int, default=USERS)
+    parser.add_argument("--latency", help="Seconds each request waits before it is answered.", type=float, default=LATENCY)
+    parser.add_argument("--seed", help="Random seed of the users.", type=int, default=SEED)
+    arguments = parser.parse_args(args or None)
+
+    stub_wiki = StubWiki(arguments.host, arguments.port, arguments.users, arguments.latency, arguments.seed)
+    print(f"Serving the stub wiki at {stub_wiki.uri}. Press Ctrl+C to stop.")
+    try:
+        stub_wiki.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
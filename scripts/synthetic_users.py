@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import random
+import sys
+
+SEED = 0
+# Share of the users with a name outside ASCII, and share of the users without an email or a registration date.
+UNICODE_RATIO = 0.3
+NULL_RATIO = 0.1
+
+# Names in several scripts, with combining characters, right-to-left text and characters outside the Basic
+# Multilingual Plane, which take 4 bytes in UTF-8 and 2 code units in UTF-16.
+ASCII_NAMES = ("Alice", "Bob", "Carol", "Dave", "Erin", "Frank", "Grace", "Heidi", "Ivan", "Judy", "Mallory", "Trent")
+UNICODE_NAMES = (
+    "José", "Zoë", "Łukasz", "Søren", "Nguyễn", "Ṣọlá", "Иван", "Ελένη", "محمد", "דוד", "अर्जुन", "太郎", "민준", "𝔊𝔯𝔢𝔱𝔢𝔩",
+    "Amélie"
+)
+EMAIL_DOMAINS = ("domain.tld", "example.org", "mail.example.com", "exämple.de")
+GROUPS = ("", "", "", "bot", "sysop", "sysop|bureaucrat")
+
+USER_FIELDS = ("user_id", "user_name", "user_real_name", "user_email", "user_registration")
+ACCOUNT_FIELDS = ("username", "password", "email", "real_name", "groups")
+
+REGISTRATION_START = datetime.datetime(2010, 1, 1)
+# https://www.mediawiki.org/wiki/Manual:Timestamp
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+
+def generate_users(count, seed=SEED, unicode_ratio=UNICODE_RATIO, null_ratio=NULL_RATIO):
+    """
+    Generates `user` table rows. The same arguments always generate the same users.
+    :param count:
+    :param seed:
+    :param unicode_ratio:
+    :param null_ratio:
+    :return: Generator of users with "user_id", "user_name", "user_real_name", "user_email" and "user_registration".
+        Missing emails and registration dates are None, and registration dates are MediaWiki timestamps.
+    """
+
+    rng = random.Random(seed)
+    for i in range(count):
+        names = (UNICODE_NAMES if rng.random() < unicode_ratio else ASCII_NAMES)
+        first_name = rng.choice(names)
+        last_name = rng.choice(names)
+
+        email = (None if rng.random() < null_ratio else f"user{i}@{rng.choice(EMAIL_DOMAINS)}")
+
+        registration = None
+        if rng.random() >= null_ratio:
+            registration = (REGISTRATION_START + datetime.timedelta(minutes=i)).strftime(TIMESTAMP_FORMAT)
+
+        yield {
+            "user_id": i + 1,
+            "user_name": f"{first_name}{last_name} {i}",
+            "user_real_name": ("" if rng.random() < null_ratio else f"{first_name} {last_name}"),
+            "user_email": email,
+            "user_registration": registration
+        }
+
+
+def generate_accounts(count, seed=SEED, unicode_ratio=UNICODE_RATIO, null_ratio=NULL_RATIO):
+    """
+    Generates accounts for `create_accounts.py --input`.
+    :param count:
+    :param seed:
+    :param unicode_ratio:
+    :param null_ratio:
+    :return: Generator of accounts with "username", "password", "email", "real_name" and "groups".
+    """
+
+    rng = random.Random(seed)
+    for user in generate_users(count, seed, unicode_ratio, null_ratio):
+        yield {
+            "username": user["user_name"],
+            "password": f"password{user['user_id']}",
+            "email": user["user_email"] or "",
+            "real_name": user["user_real_name"],
+            "groups": rng.choice(GROUPS)
+        }
+
+
+def generate_files(count, size, seed=SEED):
+    """
+    :param count:
+    :param size: Size of each file in bytes.
+    :param seed:
+    :return: Generator of files with "name" and "data", for `upload_files.py`.
+    """
+
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {
+            "name": f"Benchmark file {i}.bin",
+            "data": rng.getrandbits(size * 8).to_bytes(size, "little")
+        }
+
+
+def write_csv(rows, file, fields):
+    writer = csv.DictWriter(file, fieldnames=fields, lineterminator="\n")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_jsonl(rows, file):
+    for row in rows:
+        file.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description="Writes synthetic users or accounts to standard output.")
+    parser.add_argument("kind", help="Users, as in the user table, or accounts, as read by create_accounts.py --input.", choices=("users", "accounts"))
+    parser.add_argument("--count", help="Number of rows.", type=int, default=1000)
+    parser.add_argument("--format", help="Output format.", choices=("csv", "jsonl"), default="csv")
+    parser.add_argument("--seed", help="Random seed.", type=int, default=SEED)
+    parser.add_argument("--unicode-ratio", help="Share of the names outside ASCII.", type=float, default=UNICODE_RATIO)
+    parser.add_argument("--null-ratio", help="Share of the missing emails, real names and registration dates.", type=float, default=NULL_RATIO)
+    arguments = parser.parse_args(args or None)
+
+    generate = (generate_users if arguments.kind == "users" else generate_accounts)
+    rows = generate(arguments.count, arguments.seed, arguments.unicode_ratio, arguments.null_ratio)
+
+    if arguments.format == "jsonl":
+        write_jsonl(rows, sys.stdout)
+        return
+
+    write_csv(rows, sys.stdout, (USER_FIELDS if arguments.kind == "users" else ACCOUNT_FIELDS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+
+import pytest
+
+SCRIPTS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The scripts are not a package, so they import each other by their module names, from these directories.
+for path in (SCRIPTS_PATH, os.path.join(SCRIPTS_PATH, "update_users_excel")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from stub_wiki import StubWiki  # noqa: E402
+
+
+@pytest.fixture
+def stub_wiki(request):
+    """
+    Stub wiki for the test, which exports the number of users given by the `STUB_WIKI_USERS` of the test module. If
+    the module names the script it tests in `SCRIPT`, the script is pointed at the stub wiki and logged in.
+    """
+
+    script = getattr(request.module, "SCRIPT", None)
+
+    with StubWiki(users=getattr(request.module, "STUB_WIKI_USERS", 0)) as stub_wiki:
+        if script is not None:
+            script.API_ENDPOINT = stub_wiki.api_endpoint
+            script.session.cookies.clear()
+            script.resume_session_or_login({
+                "username": "Admin", "password": "adminpass", "return_uri": stub_wiki.uri, "session_cache_path": ""
+            })
+        yield stub_wiki
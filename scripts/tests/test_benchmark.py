@@ -0,0 +1,39 @@
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import csv
+import io
+
+import benchmark
+import synthetic_users
+
+
+def test_synthetic_users_main_parses_its_arguments(capsys):
+    synthetic_users.main("accounts", "--count", "3", "--seed", "1")
+
+    rows = list(csv.DictReader(io.StringIO(capsys.readouterr().out)))
+    assert [row["username"] for row in rows] == [
+        account["username"] for account in synthetic_users.generate_accounts(3, seed=1)
+    ]
+
+
+def test_benchmark_main_parses_its_arguments(capsys):
+    benchmark.main("--benchmarks", "create_accounts", "--accounts", "20", "--workers", "2", "--repeat", "1")
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "Stub wiki latency: 0 ms, runs per case: 1"
+    assert len(lines) == 3
+    assert lines[2].split()[:4] == ["create_accounts", "2", "workers", "20"]
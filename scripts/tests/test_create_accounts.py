@@ -0,0 +1,233 @@
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import io
+
+import create_accounts
+from journal import Journal
+
+SCRIPT = create_accounts
+
+
+def import_accounts(stub_wiki, path):
+    return create_accounts.import_accounts({
+        "path": str(path),
+        "create_account_token": create_accounts.fetch_create_account_token(),
+        "user_rights_token": create_accounts.fetch_user_rights_token(),
+        "return_uri": stub_wiki.uri,
+        "workers": 2
+    })
+
+
+def test_validate_accounts_reports_invalid_usernames():
+    accounts = list(create_accounts.validate_accounts([
+        {"password": "password"},
+        {"username": "first_user", "password": "password"},
+        {"username": "First user", "password": "password"},
+        {"username": "User#1", "password": "password"}
+    ]))
+
+    assert [account["username"] for account in accounts] == ["", "First user", "First user", "User#1"]
+    assert [account.get("error") for account in accounts] == [
+        "The username is empty.",
+        None,
+        "The username is a duplicate.",
+        "The username contains invalid characters: #"
+    ]
+
+
+def test_import_accounts_reports_blank_usernames(stub_wiki, tmp_path):
+    path = tmp_path / "accounts.csv"
+    path.write_text(
+        "username,password,email,groups\n"
+        "Alice,password,alice@domain.tld,\n"
+        ",password,blank@domain.tld,\n"
+        "Bob,password,bob@domain.tld,\n",
+        encoding="utf-8"
+    )
+
+    counts = import_accounts(stub_wiki, path)
+
+    assert counts == {create_accounts.ACCOUNT_CREATED: 2, create_accounts.ACCOUNT_FAILED: 1}
+    assert sorted(stub_wiki.accounts) == ["Alice", "Bob"]
+
+
+def test_read_accounts_numbers_the_lines():
+    file = io.StringIO("username,password\nAlice,password\n\nBob,password\n")
+
+    assert [account["line"] for account in create_accounts.read_accounts(file, "csv")] == [2, 4]
+
+
+def test_import_accounts_reports_unreadable_lines(stub_wiki, tmp_path, capsys):
+    path = tmp_path / "accounts.jsonl"
+    path.write_text(
+        '{"username": "Alice", "password": "password"}\n'
+        '{"username": 123, "password": "password"}\n'
+        '{"username": "Bob", "password": \n'
+        '["Carol", "password"]\n'
+        '{"username": "Dave", "password": "password", "groups": [1]}\n'
+        '{"username": "Erin", "password": "password"}\n',
+        encoding="utf-8"
+    )
+
+    counts = import_accounts(stub_wiki, path)
+
+    assert counts == {create_accounts.ACCOUNT_CREATED: 2, create_accounts.ACCOUNT_FAILED: 4}
+    assert sorted(stub_wiki.accounts) == ["Alice", "Erin"]
+
+    output = capsys.readouterr().out
+    assert "123: Line 2: The username is not a string." in output
+    assert "Line 3: The line is not valid JSON" in output
+    assert "Line 4: The line is not a JSON object." in output
+    assert "Dave: Line 5: The groups are not a string or a list of strings." in output
+
+
+def test_import_accounts_reads_json_lines(stub_wiki, tmp_path):
+    path = tmp_path / "accounts.jsonl"
+    path.write_text(
+        '{"username": "José", "password": "password", "groups": ["bot"]}\n'
+        "\n"
+        '{"username": "太郎", "password": "password", "email": "taro@domain.tld"}\n',
+        encoding="utf-8"
+    )
+
+    counts = import_accounts(stub_wiki, path)
+
+    assert counts == {create_accounts.ACCOUNT_CREATED: 2, create_accounts.ACCOUNT_GROUPED: 1}
+    assert stub_wiki.accounts["José"]["groups"] == {"bot"}
+    assert "太郎" in stub_wiki.accounts
+
+
+def test_import_accounts_counts_created_and_grouped_accounts(stub_wiki, tmp_path):
+    path = tmp_path / "accounts.csv"
+    path.write_text(
+        "username,password,groups\n"
+        "Alice,password,\n"
+        "Bob,password,bot|sysop\n",
+        encoding="utf-8"
+    )
+
+    counts = import_accounts(stub_wiki, path)
+
+    assert counts == {create_accounts.ACCOUNT_CREATED: 2, create_accounts.ACCOUNT_GROUPED: 1}
+    assert stub_wiki.accounts["Bob"]["groups"] == {"bot", "sysop"}
+
+    # Accounts that exist are only added to the groups they are missing.
+    path.write_text("username,password,groups\nAlice,password,bot\nBob,password,bot\n", encoding="utf-8")
+
+    counts = import_accounts(stub_wiki, path)
+
+    assert counts == {create_accounts.ACCOUNT_EXISTS: 2, create_accounts.ACCOUNT_GROUPED: 1}
+    assert stub_wiki.accounts["Alice"]["groups"] == {"bot"}
+
+
+def test_create_accounts_resumes_from_journal(stub_wiki, tmp_path):
+    accounts = [{"username": username, "password": "password", "email": ""} for username in ("Alice", "Bob", "Carol")]
+    option = {"token": create_accounts.fetch_create_account_token(), "return_uri": stub_wiki.uri}
+    journal_path = str(tmp_path / "journal.jsonl")
+
+    with Journal(journal_path) as journal:
+        create_accounts.create_accounts(dict(option, accounts=accounts[:2], journal=journal))
+
+    with Journal(journal_path) as journal:
+        results = create_accounts.create_accounts(dict(option, accounts=accounts, journal=journal, resume=True))
+        assert list(journal.filter_unfinished(["Alice", "Bob", "Carol"])) == []
+
+    assert results["Alice"] is None and results["Bob"] is None
+    assert results["Carol"]["createaccount"]["status"] == "PASS"
+    assert sorted(stub_wiki.accounts) == ["Alice", "Bob", "Carol"]
+
+
+def test_provision_accounts_keeps_the_result_of_a_duplicate_username(stub_wiki, tmp_path):
+    accounts = [{"username": "Alice", "password": "password"}, {"username": "alice", "password": "password"}]
+    journal_path = str(tmp_path / "journal.jsonl")
+
+    with Journal(journal_path) as journal:
+        results = create_accounts.provision_accounts({
+            "accounts": create_accounts.validate_accounts(accounts),
+            "create_account_token": create_accounts.fetch_create_account_token(),
+            "user_rights_token": create_accounts.fetch_user_rights_token(),
+            "return_uri": stub_wiki.uri,
+            "journal": journal
+        })
+
+    assert [(result["username"], result["status"]) for result in results] == [
+        ("Alice", create_accounts.ACCOUNT_CREATED), ("alice", create_accounts.ACCOUNT_FAILED)
+    ]
+    assert create_accounts.format_results_table(results).splitlines()[-1] == (
+        "Created: 1, Exists: 0, Failed: 1, Grouped: 0, Grouping failed: 0"
+    )
+
+    # Only the account that was sent to the wiki is journaled, so a resumed run skips it.
+    with Journal(journal_path) as journal:
+        assert journal.read_finished_keys() == {"Alice"}
+        assert list(journal.filter_unfinished(["Alice"])) == []
+
+
+def test_format_results_table_shows_both_statuses():
+    results = [
+        {"username": "Alice", "status": "created", "groups_status": "grouped", "detail": {"userrights": {}}},
+        {"username": "Bob", "status": "created", "groups_status": "grouping failed", "detail": "Timed out."},
+        {"username": "Carol", "status": "exists", "groups_status": None, "detail": None}
+    ]
+
+    assert create_accounts.format_results_table(results).splitlines() == [
+        "Username  Status                    Detail",
+        "Alice     created, grouped",
+        "Bob       created, grouping failed  Timed out.",
+        "Carol     exists",
+        "Created: 2, Exists: 1, Failed: 0, Grouped: 1, Grouping failed: 1"
+    ]
+
+
+def test_change_users_group_membership_skips_unneeded_changes(stub_wiki):
+    stub_wiki.accounts.update({
+        "Alice": {"userid": 1, "groups": {"bot"}},
+        "Bob": {"userid": 2, "groups": {"sysop"}}
+    })
+
+    results = create_accounts.change_users_group_membership({
+        "changes": {
+            "Alice": {"add_groups": "bot"},
+            "Bob": {"add_groups": ["bot"], "remove_groups": "sysop"},
+            "Carol": {"add_groups": "bot"}
+        },
+        "token": create_accounts.fetch_user_rights_token(),
+        "workers": 2
+    })
+
+    assert results["Alice"] is None
+    assert results["Carol"] is None
+    assert "userrights" in results["Bob"]
+    assert stub_wiki.accounts["Bob"]["groups"] == {"bot"}
+
+
+def test_create_accounts_skips_existing_accounts(stub_wiki):
+    stub_wiki.accounts["Alice"] = {"userid": 1, "groups": set()}
+    accounts = [
+        {"username": "Alice", "password": "password", "email": ""},
+        {"username": "Bob", "password": "password", "email": ""}
+    ]
+
+    requests_before = stub_wiki.requests
+    results = create_accounts.create_accounts({
+        "accounts": accounts, "token": create_accounts.fetch_create_account_token(), "return_uri": stub_wiki.uri
+    })
+
+    assert results["Alice"] is None
+    assert results["Bob"]["createaccount"]["status"] == "PASS"
+    # One request for the tokens, one to look up both usernames and one to create Bob.
+    assert stub_wiki.requests - requests_before == 3
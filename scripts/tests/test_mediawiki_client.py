@@ -0,0 +1,46 @@
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from mediawiki_client import MediaWikiClient
+from synthetic_users import generate_files
+
+
+def test_client_creates_accounts_and_uploads_files(stub_wiki):
+    files = list(generate_files(10, 256))
+
+    async def run():
+        async with MediaWikiClient(stub_wiki.api_endpoint, limit=4) as client:
+            login = await client.login("Admin", "adminpass", stub_wiki.uri)
+            assert login["clientlogin"]["status"] == "PASS"
+
+            token = await client.fetch_create_account_token()
+            account = await client.create_account("Alice", "password", "alice@domain.tld", stub_wiki.uri, token)
+            assert account["createaccount"]["status"] == "PASS"
+
+            token = await client.fetch_csrf_token()
+            return await asyncio.gather(*(client.upload_file(file["name"], file["data"], token) for file in files))
+
+    results = asyncio.run(run())
+
+    assert [result["upload"]["result"] for result in results] == ["Success"] * 10
+    assert sorted(stub_wiki.files) == sorted(file["name"] for file in files)
+    assert "Alice" in stub_wiki.accounts
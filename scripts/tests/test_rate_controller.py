@@ -0,0 +1,114 @@
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import requests
+
+import rate_controller
+from rate_controller import MAXLAG, RateController, mount_connection_pool, post_with_rate_control, split_into_batches
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, data=None, headers=None):
+        self.status_code = status_code
+        self.data = (data if data is not None else {"edit": {"result": "Success"}})
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.bodies = []
+
+    def post(self, url, files=None, data=None):
+        self.bodies.append(data)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def post(session, retries=2, limiter=None):
+    retries_seen = []
+    response = post_with_rate_control(
+        session, "https://wiki/api.php", {"action": "edit"}, limiter or RateController(4), retries=retries,
+        on_retry=lambda action, reason: retries_seen.append((action, reason))
+    )
+    return response, retries_seen
+
+
+def test_post_with_rate_control_sends_maxlag():
+    session = FakeSession([FakeResponse()])
+
+    response, retries_seen = post(session)
+
+    assert response.status_code == 200
+    assert session.bodies == [{"action": "edit", "maxlag": MAXLAG}]
+    assert retries_seen == []
+
+
+def test_post_with_rate_control_retries_transient_failures(monkeypatch):
+    monkeypatch.setattr(rate_controller.time, "sleep", lambda delay: None)
+    session = FakeSession([requests.ConnectionError("reset"), FakeResponse(502), FakeResponse()])
+
+    response, retries_seen = post(session)
+
+    assert response.status_code == 200
+    assert retries_seen == [("edit", "ConnectionError"), ("edit", "http-502")]
+
+
+def test_post_with_rate_control_returns_the_last_failure(monkeypatch):
+    monkeypatch.setattr(rate_controller.time, "sleep", lambda delay: None)
+    limiter = RateController(4, limit=2)
+    session = FakeSession([FakeResponse(502), FakeResponse(502), FakeResponse(502)])
+
+    response, retries_seen = post(session, limiter=limiter)
+
+    assert response.status_code == 502
+    assert len(session.bodies) == 3
+    assert len(retries_seen) == 2
+    # None of the requests went through, so the limit was not raised.
+    assert limiter.limit == 2
+
+
+def test_post_with_rate_control_waits_when_throttled():
+    limiter = RateController(4)
+    session = FakeSession([FakeResponse(data={"error": {"code": "maxlag"}}, headers={"Retry-After": "0"}), FakeResponse()])
+
+    response = post_with_rate_control(session, "https://wiki/api.php", {"action": "edit"}, limiter)
+
+    assert response.status_code == 200
+    assert len(session.bodies) == 2
+    # The throttle signal halved the limit, and the success after it raised it again by 1/limit.
+    assert limiter.limit == 2.5
+
+
+def test_split_into_batches():
+    assert list(split_into_batches(list(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(split_into_batches([], 2)) == []
+
+
+def test_mount_connection_pool_caps_the_limit():
+    session = requests.Session()
+    limiter = RateController(8)
+
+    mount_connection_pool(session, limiter, 4)
+
+    assert limiter.max_limit == 4
+    assert limiter.limit == 4
+    assert session.get_adapter("https://wiki/api.php") is session.get_adapter("http://wiki/api.php")
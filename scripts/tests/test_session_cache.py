@@ -0,0 +1,124 @@
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+
+import pytest
+import requests
+
+from session_cache import SessionRefresher, get_session_error_code
+
+
+def create_session_refresher(stub_wiki, login_status="PASS"):
+    session = requests.Session()
+
+    def fetch_tokens(token_type):
+        response = session.get(stub_wiki.api_endpoint, params={"action": "query", "meta": "tokens", "type": token_type, "format": "json"})
+        return response.json()["query"]["tokens"]
+
+    def login(option):
+        if login_status != "PASS":
+            return {"clientlogin": {"status": login_status, "message": "Incorrect password."}}
+        return session.post(stub_wiki.api_endpoint, data={
+            "action": "clientlogin",
+            "username": option["username"],
+            "password": option["password"],
+            "loginreturnurl": option["return_uri"],
+            "logintoken": option["token"],
+            "format": "json"
+        }).json()
+
+    return SessionRefresher(session, login, fetch_tokens)
+
+
+def create_login_option(stub_wiki, path):
+    return {"username": "Admin", "password": "adminpass", "return_uri": stub_wiki.uri, "session_cache_path": str(path)}
+
+
+def test_session_is_cached_after_login(stub_wiki, tmp_path):
+    path = tmp_path / "session.json"
+    session_refresher = create_session_refresher(stub_wiki)
+
+    assert session_refresher.resume_session_or_login(stub_wiki.api_endpoint, create_login_option(stub_wiki, path)) is None
+    assert session_refresher.logged_in
+    session_refresher.save_session("0123456789abcdef+\\")
+
+    session_cache = json.loads(path.read_text())
+    assert session_cache["username"] == "Admin"
+    assert session_cache["csrf_token"] == "0123456789abcdef+\\"
+
+    resumed_session_refresher = create_session_refresher(stub_wiki)
+    option = create_login_option(stub_wiki, path)
+    assert resumed_session_refresher.resume_session_or_login(stub_wiki.api_endpoint, option) == session_cache
+    assert resumed_session_refresher.logged_in
+
+
+def test_failed_login_is_not_cached(stub_wiki, tmp_path):
+    path = tmp_path / "session.json"
+    session_refresher = create_session_refresher(stub_wiki, login_status="FAIL")
+
+    session_refresher.resume_session_or_login(stub_wiki.api_endpoint, create_login_option(stub_wiki, path))
+    session_refresher.save_session("+\\")
+
+    assert not session_refresher.logged_in
+    assert not path.exists()
+
+
+def test_anonymous_csrf_token_is_not_cached(stub_wiki, tmp_path):
+    path = tmp_path / "session.json"
+    session_refresher = create_session_refresher(stub_wiki)
+
+    session_refresher.resume_session_or_login(stub_wiki.api_endpoint, create_login_option(stub_wiki, path))
+    session_refresher.save_session("+\\")
+
+    assert json.loads(path.read_text())["csrf_token"] is None
+
+
+def test_expired_session_is_refreshed_once(stub_wiki, tmp_path):
+    session_refresher = create_session_refresher(stub_wiki)
+    session_refresher.resume_session_or_login(stub_wiki.api_endpoint, create_login_option(stub_wiki, tmp_path / "session.json"))
+    stub_wiki.sessions.clear()
+
+    def post(body, files):
+        return session_refresher.session.post(stub_wiki.api_endpoint, data=body, files=files)
+
+    body = {"action": "upload", "filename": "Test.txt", "token": "stale", "format": "json", "ignorewarnings": 1}
+    response = session_refresher.post_with_token(post, body, "csrf", files={"file": ("Test.txt", b"test")})
+
+    assert response.json()["upload"]["result"] == "Success"
+    assert session_refresher.generation == 1
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        if isinstance(self.data, Exception):
+            raise self.data
+        return self.data
+
+
+@pytest.mark.parametrize("data, error_code", [
+    ({"error": {"code": "badtoken"}}, "badtoken"),
+    ({"error": {"code": "maxlag"}}, None),
+    ({"error": "badtoken"}, None),
+    (["badtoken"], None),
+    (None, None),
+    (ValueError("No JSON object could be decoded"), None)
+])
+def test_get_session_error_code(data, error_code):
+    assert get_session_error_code(FakeResponse(data)) == error_code
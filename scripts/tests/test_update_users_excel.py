@@ -0,0 +1,416 @@
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from collections import OrderedDict
+from contextlib import closing, redirect_stdout
+from copy import deepcopy
+from types import SimpleNamespace
+from zipfile import ZipFile
+import datetime
+import hashlib
+import io
+import time
+
+from openpyxl import load_workbook
+from openpyxl.styles.numbers import FORMAT_GENERAL, FORMAT_TEXT
+import openpyxl.packaging.core
+import pytest
+
+from synthetic_users import generate_users
+from update_users_excel import (
+    CONFIG, ConfigModel, DatabaseController, DatabaseModel, ExportController, ExportModel, ExportUserController,
+    MainController, StageProfileController, UserModel, UserStoreController, UserTable, WikiConfigModel, WikiController,
+    WorkbookController, WorkbookEngine
+)
+
+STUB_WIKI_USERS = 100
+
+FIELD_TITLE = OrderedDict([
+    ("user_name", "Username"),
+    ("user_real_name", "Name"),
+    ("user_email", "Email"),
+    ("user_registration", "Registration date")
+])
+FIELDS = list(FIELD_TITLE.keys())
+TITLES = list(FIELD_TITLE.values())
+
+
+def create_users(count):
+    return list(UserModel.format_user_dates(generate_users(count)))
+
+
+def save_and_load(workbook, path):
+    controller = WorkbookController()
+    controller.save_workbook(workbook, path)
+    buffer = controller.fix_workbook_mime_type(str(path))
+    with open(path, "wb") as file:
+        file.write(buffer.getvalue())
+    return load_workbook(path)
+
+
+def get_table_refs(worksheet):
+    # openpyxl 3.0.2 has no `Worksheet.tables` yet.
+    tables = (worksheet.tables.values() if hasattr(worksheet, "tables") else worksheet._tables)
+    return {table.displayName: table.ref for table in tables}
+
+
+def get_values(worksheet):
+    return [[cell.value for cell in row] for row in worksheet.iter_rows()]
+
+
+def test_write_only_workbook_round_trip(tmp_path):
+    users = create_users(50)
+    controller = WorkbookController()
+
+    default_workbook = save_and_load(
+        controller.create_users_workbook(FIELD_TITLE, FIELDS, TITLES, users), tmp_path / "default.xlsx"
+    )
+    workbook = save_and_load(
+        controller.create_users_workbook_write_only(FIELD_TITLE, FIELDS, TITLES, iter(users)), tmp_path / "write-only.xlsx"
+    )
+
+    sheet = workbook["Users"]
+    default_sheet = default_workbook["Users"]
+    assert get_values(sheet) == get_values(default_sheet)
+    assert len(get_values(sheet)) == len(users) + 2
+    assert get_table_refs(sheet) == {"User": f"A1:D{len(users) + 2}"}
+    assert isinstance(sheet["D2"].value, datetime.datetime) or sheet["D2"].value is None
+
+    # The column widths and the selection are written after the rows, when they are known.
+    for letter in "ABCD":
+        assert sheet.column_dimensions[letter].width == default_sheet.column_dimensions[letter].width
+    assert sheet.sheet_view.selection[0].activeCell == f"A{len(users) + 3}"
+
+
+def test_multi_sheet_workbook_round_trip(tmp_path):
+    users = create_users(200)
+    user_table = UserTable.from_rows(FIELDS, users)
+    controller = WorkbookController()
+
+    workbook = save_and_load(
+        controller.create_multi_sheet_users_workbook(FIELD_TITLE, FIELDS, TITLES, user_table, processes=2),
+        tmp_path / "multi-sheet.xlsx"
+    )
+
+    assert workbook.sheetnames == ["Users", "Registrations by month", "Email domains"]
+
+    users_sheet = workbook["Users"]
+    assert len(get_values(users_sheet)) == len(users) + 2
+    assert get_table_refs(users_sheet) == {"User": f"A1:D{len(users) + 2}"}
+
+    # The sheets were rendered in other workbooks, so their cells must still refer to the right styles.
+    registration = next(user["user_registration"] for user in users if user["user_registration"] is not None)
+    registration_cell = next(row[3] for row in users_sheet.iter_rows(min_row=2) if row[3].value == registration)
+    assert registration_cell.number_format == WorkbookController.ISO_8601_NUMBER_FORMAT
+
+    for title, table_name in (("Registrations by month", "RegistrationsByMonth"), ("Email domains", "EmailDomains")):
+        values = get_values(workbook[title])
+        assert sum(row[1] for row in values[1:-1]) == len(users)
+        assert values[-1][0] == "Total"
+        assert get_table_refs(workbook[title]) == {table_name: f"A1:B{len(values)}"}
+
+
+def test_fix_workbook_mime_type_moves_the_package_parts_first(tmp_path):
+    path = tmp_path / "users.xlsx"
+    controller = WorkbookController()
+    controller.create_users_workbook(FIELD_TITLE, FIELDS, TITLES, create_users(20)).save(path)
+
+    buffer = controller.fix_workbook_mime_type(str(path))
+
+    with ZipFile(path) as zip_file, ZipFile(buffer) as fixed_zip_file:
+        assert fixed_zip_file.testzip() is None
+        assert fixed_zip_file.namelist()[:3] == WorkbookController.FIRST_NAMES
+        assert sorted(fixed_zip_file.namelist()) == sorted(zip_file.namelist())
+        for name in zip_file.namelist():
+            assert fixed_zip_file.read(name) == zip_file.read(name)
+
+
+def freeze_clock(monkeypatch, now):
+    """
+    Sets the clock that the zip members and the default document properties of new workbooks take their times from.
+    """
+
+    class FrozenDateTime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now.replace(tzinfo=tz)
+
+    monkeypatch.setattr(time, "time", lambda: now.timestamp())
+    frozen_datetime_module = SimpleNamespace(datetime=FrozenDateTime, timezone=datetime.timezone)
+    monkeypatch.setattr(openpyxl.packaging.core, "datetime", frozen_datetime_module)
+
+
+@pytest.mark.parametrize("engine", list(WorkbookEngine))
+def test_saved_workbook_is_reproducible(monkeypatch, engine):
+    users = create_users(20)
+    controller = WorkbookController()
+    if engine == WorkbookEngine.WRITE_ONLY:
+        create_users_workbook = controller.create_users_workbook_write_only
+    else:
+        create_users_workbook = controller.create_users_workbook
+
+    def save_at(now):
+        freeze_clock(monkeypatch, now)
+        buffer = io.BytesIO()
+        with closing(create_users_workbook(FIELD_TITLE, FIELDS, TITLES, iter(users))) as workbook:
+            controller.save_workbook(workbook, buffer)
+        return buffer, controller.fix_workbook_mime_type(buffer)
+
+    first_buffer, first_fixed_buffer = save_at(datetime.datetime(2019, 1, 1, 12, 0, 0))
+    second_buffer, second_fixed_buffer = save_at(datetime.datetime(2020, 6, 15, 8, 30, 0))
+
+    with ZipFile(first_buffer) as first_zip_file, ZipFile(second_buffer) as second_zip_file:
+        # The clock was frozen at different times for the two saves.
+        assert first_zip_file.infolist()[0].date_time != second_zip_file.infolist()[0].date_time
+        core_properties = first_zip_file.read("docProps/core.xml")
+        assert core_properties == second_zip_file.read("docProps/core.xml")
+        assert b"1980-01-01T00:00:00Z" in core_properties
+
+    assert first_fixed_buffer.getvalue() == second_fixed_buffer.getvalue()
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetch_sizes = []
+        self.closed = False
+
+    def execute(self, query, params=None):
+        self.query = query
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def __init__(self, rows, **kwargs):
+        self.kwargs = kwargs
+        self.cursor_kwargs = None
+        self.fake_cursor = FakeCursor(rows)
+        self.closed = False
+
+    def cursor(self, **kwargs):
+        self.cursor_kwargs = kwargs
+        return self.fake_cursor
+
+    def close(self):
+        self.closed = True
+
+
+def test_database_rows_are_fetched_in_batches(monkeypatch):
+    users = [{field: user[field] for field in FIELDS} for user in generate_users(25)]
+    connections = []
+
+    def connect(self, **kwargs):
+        connections.append(FakeConnection(list(users), **kwargs))
+        return connections[-1]
+
+    monkeypatch.setattr(DatabaseController, "connect", connect)
+    monkeypatch.setattr(DatabaseController, "FETCH_BATCH_SIZE", 10)
+    database_controller = DatabaseController(DatabaseModel(user_field_title=FIELD_TITLE))
+
+    assert list(database_controller.fetch_users()) == users
+
+    connection = connections[-1]
+    assert connection.kwargs == {"consume_results": True}
+    assert connection.cursor_kwargs == {"dictionary": True, "buffered": False}
+    assert connection.fake_cursor.fetch_sizes == [10, 10, 10, 10]
+    assert connection.closed and connection.fake_cursor.closed
+
+    # Closing the generator early closes the cursor and the connection without fetching the rest.
+    rows = database_controller.execute_iter("select 1")
+    assert next(rows) == users[0]
+    rows.close()
+    assert connections[-1].fake_cursor.fetch_sizes == [10]
+    assert connections[-1].closed and connections[-1].fake_cursor.closed
+
+
+def test_user_store_keeps_users_between_runs(tmp_path):
+    path = str(tmp_path / "users.sqlite")
+    users = list(generate_users(30))
+
+    user_store = UserStoreController(path, "user_id", FIELDS)
+    assert user_store.last_user_id() == 0
+
+    user_store.add_users(users[:20])
+    user_store.add_users(users[15:])
+    assert user_store.last_user_id() == 30
+    assert list(user_store.fetch_users()) == [{field: user[field] for field in FIELDS} for user in users]
+
+    # A store created with other fields is dropped, so that the next run fetches all the users again.
+    user_store = UserStoreController(path, "user_id", FIELDS[:2])
+    assert user_store.last_user_id() == 0
+
+
+def test_user_table():
+    users = list(generate_users(20))
+    user_table = UserTable.from_rows(FIELDS, users)
+
+    assert len(user_table) == 20
+    assert list(user_table) == [{field: user[field] for field in FIELDS} for user in users]
+    assert list(UserTable.from_tuples(FIELDS, ([user[field] for field in FIELDS] for user in users))) == list(user_table)
+    assert user_table.measure_column("user_name") == max(len(user["user_name"]) for user in users)
+
+    UserModel.format_user_table_dates(user_table)
+    assert user_table.columns["user_registration"] == [
+        UserModel.format_date(user["user_registration"]) for user in users
+    ]
+    assert len(UserTable(FIELDS)) == 0 and len(UserTable([])) == 0
+
+
+@pytest.mark.parametrize("timestamp, date", [
+    ("20190102030405", datetime.datetime(2019, 1, 2, 3, 4, 5)),
+    (b"20191231235959", datetime.datetime(2019, 12, 31, 23, 59, 59)),
+    ("", None),
+    (None, None)
+])
+def test_format_date(timestamp, date):
+    assert UserModel.format_date(timestamp) == date
+
+
+@pytest.mark.parametrize("timestamp", ["2019010203040", "20191301000000"])
+def test_format_date_rejects_invalid_timestamps(timestamp):
+    with pytest.raises(ValueError):
+        UserModel.format_date(timestamp)
+
+
+def test_stage_profile_counts_only_the_own_time_of_each_stage(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(time, "perf_counter", lambda: clock[0])
+
+    def advance(seconds):
+        clock[0] += seconds
+
+    def parse(count):
+        for i in range(count):
+            advance(0.5)
+            yield i
+
+    stage_profile = StageProfileController()
+    stage_profile.start()
+    with stage_profile.stage("fetch"):
+        advance(1)
+        for _ in stage_profile.iterate("parse", parse(3)):
+            # The time spent on each item outside `next` belongs to the enclosing stage.
+            advance(2)
+        advance(1)
+    with stage_profile.stage("upload"):
+        advance(4)
+    stage_profile.stop()
+
+    assert {name: model.elapsed for name, model in stage_profile.models.items()} == {
+        "fetch": 8.0, "parse": 1.5, "upload": 4.0
+    }
+    assert stage_profile.elapsed == 13.5
+    assert [line.split()[0] for line in stage_profile.format_summary().splitlines()] == [
+        "Stage", "fetch", "parse", "upload", "total"
+    ]
+
+
+def test_decode_lines_joins_characters_split_across_chunks():
+    data = "user_name\r\nJosé\r\n太郎\r\n𝔊𝔯𝔢𝔱𝔢𝔩".encode("utf-8")
+    chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+
+    assert list(ExportUserController.decode_lines(chunks)) == ["user_name\r\n", "José\r\n", "太郎\r\n", "𝔊𝔯𝔢𝔱𝔢𝔩"]
+    assert list(ExportUserController.decode_lines([])) == []
+
+
+def run_main_controller(stub_wiki, tmp_path, **config_values):
+    config = deepcopy(CONFIG)
+    config.update({
+        "wiki_uri": stub_wiki.uri,
+        "wiki_session_cache_path": str(tmp_path / "session.json"),
+        "users_excel_file_path": str(tmp_path / config["users_excel_file_name"]),
+        "force_upload": True
+    })
+    config.update(config_values)
+    main_controller = MainController(ConfigModel(config))
+    with redirect_stdout(io.StringIO()):
+        main_controller.run()
+    return main_controller
+
+
+def count_requests(main_controller, action):
+    metrics = main_controller.request_metrics.actions.get(action)
+    return (metrics.count if metrics is not None else 0)
+
+
+def test_export_resumes_cached_session(stub_wiki, tmp_path):
+    first_run = run_main_controller(stub_wiki, tmp_path)
+    second_run = run_main_controller(stub_wiki, tmp_path)
+
+    assert count_requests(first_run, "clientlogin") == 1
+    assert count_requests(second_run, "clientlogin") == 0
+    assert count_requests(second_run, "Special:Userexport") == 1
+    assert len(get_values(load_workbook(tmp_path / CONFIG["users_excel_file_name"])["Users"])) == 102
+
+
+def test_format_cell_writes_numbers_as_numbers_and_other_values_as_text():
+    assert WorkbookController.format_cell(datetime.datetime(2019, 1, 1)) == (WorkbookController.ISO_8601_NUMBER_FORMAT, "d")
+    assert WorkbookController.format_cell(3) == (FORMAT_GENERAL, "n")
+    assert WorkbookController.format_cell(0.5) == (FORMAT_GENERAL, "n")
+    assert WorkbookController.format_cell(True) == (FORMAT_TEXT, "s")
+    assert WorkbookController.format_cell("42") == (FORMAT_TEXT, "s")
+    assert WorkbookController.format_cell(None) == (FORMAT_TEXT, "s")
+
+
+def test_export_counts_the_bytes_of_the_streamed_csv(stub_wiki, tmp_path):
+    main_controller = run_main_controller(stub_wiki, tmp_path)
+
+    export_metrics = main_controller.request_metrics.actions["Special:Userexport"]
+    # The stub wiki streams the CSV without a Content-Length, so the bytes are counted as they are read.
+    assert export_metrics.bytes_received > 100 * len("User\n")
+
+
+def test_export_uploads_the_workbook_in_chunks(stub_wiki, tmp_path):
+    main_controller = run_main_controller(stub_wiki, tmp_path, upload_chunk_size=4096)
+
+    workbook_bytes = (tmp_path / CONFIG["users_excel_file_name"]).read_bytes()
+    assert stub_wiki.files[CONFIG["users_excel_file_name"]] == hashlib.sha1(workbook_bytes).hexdigest()
+    assert count_requests(main_controller, "upload") > len(workbook_bytes) // 4096
+    assert stub_wiki.stash == {}
+
+
+def test_wiki_controller_does_not_cache_a_failed_login(stub_wiki, tmp_path, monkeypatch):
+    session_cache_path = tmp_path / "session.json"
+    wiki_controller = WikiController(
+        WikiConfigModel(uri=stub_wiki.uri, api_path="/api.php", username="Admin", password="wrong"),
+        str(session_cache_path)
+    )
+    monkeypatch.setattr(wiki_controller, "login", lambda token=None, return_uri=None: {"clientlogin": {"status": "FAIL"}})
+
+    wiki_controller.resume_session_or_login()
+    wiki_controller.csrf_token
+
+    assert not wiki_controller.session_refresher.logged_in
+    assert not session_cache_path.exists()
+
+
+def test_export_controller_logs_in_without_wiki_controller(stub_wiki):
+    export_model = ExportModel(
+        uri=stub_wiki.uri, api_path="/api.php", username="Admin", password="adminpass",
+        user_field_title=CONFIG["wiki_user_field_title"]
+    )
+
+    export_controller = ExportController(export_model)
+
+    assert export_controller.wiki_controller.session_refresher.logged_in
+    assert len(list(export_controller.fetch_users())) == 100
@@ -0,0 +1,127 @@
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from contextlib import closing
+import hashlib
+
+import file_upload
+import upload_files
+from journal import Journal
+from synthetic_users import generate_files
+
+SCRIPT = upload_files
+
+
+def test_read_cached_sha1s_reads_only_the_names_asked_for(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload_files, "CACHE_QUERY_LIMIT", 3)
+    sha1s = {f"File {i}.txt": f"{i:040x}" for i in range(10)}
+
+    with closing(upload_files.open_cache(str(tmp_path / "cache.sqlite"))) as connection:
+        upload_files.write_cached_sha1s(connection, sha1s)
+        names = [f"File {i}.txt" for i in range(0, 12, 2)]
+
+        assert upload_files.read_cached_sha1s(connection, names) == {name: sha1s[name] for name in names[:5]}
+        assert upload_files.read_cached_sha1s(connection, []) == {}
+
+
+def test_upload_changed_files_skips_unchanged_files(stub_wiki, tmp_path):
+    files = list(generate_files(20, 256))
+    option = {
+        "files": files,
+        "token": upload_files.fetch_csrf_token(),
+        "workers": 4,
+        "cache_path": str(tmp_path / "cache.sqlite")
+    }
+
+    results = upload_files.upload_changed_files(option)
+    assert all(result["upload"]["result"] == "Success" for result in results)
+    assert len(stub_wiki.files) == 20
+
+    # The cache vouches for every file, so nothing is looked up or uploaded again.
+    requests_before = stub_wiki.requests
+    assert upload_files.upload_changed_files(option) == [None] * 20
+    assert stub_wiki.requests == requests_before
+
+    files[0] = dict(files[0], data=b"changed")
+    results = upload_files.upload_changed_files(dict(option, files=files))
+    assert results[0]["upload"]["result"] == "Success"
+    assert results[1:] == [None] * 19
+
+
+def test_upload_changed_files_resumes_from_journal(stub_wiki, tmp_path):
+    files = list(generate_files(10, 256))
+    journal_path = str(tmp_path / "journal.jsonl")
+    option = {"token": upload_files.fetch_csrf_token(), "workers": 2, "cache_path": str(tmp_path / "cache.sqlite")}
+
+    with Journal(journal_path) as journal:
+        upload_files.upload_changed_files(dict(option, files=files[:4], journal=journal))
+
+    with Journal(journal_path) as journal:
+        results = upload_files.upload_changed_files(dict(option, files=files, journal=journal, resume=True))
+
+    assert results[:4] == [None] * 4
+    assert all(result["upload"]["result"] == "Success" for result in results[4:])
+    assert len(stub_wiki.files) == 10
+
+
+def test_upload_file_in_chunks(stub_wiki, tmp_path):
+    path = tmp_path / "Chunked.bin"
+    data = next(generate_files(1, 10000))["data"]
+    path.write_bytes(data)
+
+    result = upload_files.upload_file_in_chunks({
+        "name": "Chunked.bin", "path": str(path), "token": upload_files.fetch_csrf_token(), "chunk_size": 4096
+    })
+
+    assert result["upload"]["result"] == "Success"
+    assert stub_wiki.files["Chunked.bin"] == upload_files.compute_sha1(data)
+    assert stub_wiki.stash == {}
+
+
+def test_upload_file_in_chunks_retries_a_failed_chunk(stub_wiki, tmp_path, monkeypatch):
+    path = tmp_path / "Chunked.bin"
+    data = next(generate_files(1, 10000))["data"]
+    path.write_bytes(data)
+
+    upload_file_chunk = file_upload.upload_file_chunk
+    offsets = []
+
+    def fail_once(post, option):
+        offsets.append(option["offset"])
+        if len(offsets) == 2:
+            raise upload_files.requests.ConnectionError("Connection reset.")
+        return upload_file_chunk(post, option)
+
+    monkeypatch.setattr(file_upload, "upload_file_chunk", fail_once)
+
+    result = upload_files.upload_file_in_chunks({
+        "name": "Chunked.bin", "path": str(path), "token": upload_files.fetch_csrf_token(), "chunk_size": 4096
+    })
+
+    assert result["upload"]["result"] == "Success"
+    assert offsets == [0, 4096, 4096, 8192]
+    assert stub_wiki.files["Chunked.bin"] == upload_files.compute_sha1(data)
+
+
+def test_upload_files_concurrently_keeps_the_order_of_the_files(stub_wiki):
+    files = list(generate_files(12, 256))
+
+    results = upload_files.upload_files_concurrently({
+        "files": files, "token": upload_files.fetch_csrf_token(), "workers": 4
+    })
+
+    assert [result["upload"]["filename"] for result in results] == [file["name"] for file in files]
+    assert stub_wiki.files == {file["name"]: hashlib.sha1(file["data"]).hexdigest() for file in files}
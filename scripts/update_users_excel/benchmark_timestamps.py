@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import datetime
+import timeit
+
+from update_users_excel import UserModel
+
+TIMESTAMPS = 100000
+REPEAT = 5
+
+
+def generate_timestamps(count):
+    start = datetime.datetime(2010, 1, 1)
+    return [(start + datetime.timedelta(minutes=i)).strftime(UserModel.TIMESTAMP_FORMAT) for i in range(count)]
+
+
+def parse_with_strptime(timestamps):
+    timestamp_format = UserModel.TIMESTAMP_FORMAT
+    return [datetime.datetime.strptime(timestamp, timestamp_format) for timestamp in timestamps]
+
+
+def parse_with_format_date(timestamps):
+    format_date = UserModel.format_date
+    return [format_date(timestamp) for timestamp in timestamps]
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description="Compares UserModel.format_date with datetime.strptime.")
+    parser.add_argument("--timestamps", help="Number of timestamps to parse.", type=int, default=TIMESTAMPS, metavar=TIMESTAMPS)
+    parser.add_argument("--repeat", help="Number of runs. The fastest one is reported.", type=int, default=REPEAT, metavar=REPEAT)
+    arguments = parser.parse_args(args or None)
+
+    timestamps = generate_timestamps(arguments.timestamps)
+    if parse_with_strptime(timestamps) != parse_with_format_date(timestamps):
+        raise AssertionError("UserModel.format_date and datetime.strptime disagree.")
+
+    results = []
+    for function in (parse_with_strptime, parse_with_format_date):
+        seconds = min(timeit.repeat(lambda: function(timestamps), number=1, repeat=arguments.repeat))
+        results.append(seconds)
+        print(f"{function.__name__:<24}{seconds:>8.3f} s{arguments.timestamps / seconds:>14,.0f} timestamps/s")
+
+    print(f"Speedup: {results[0] / results[1]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Copyright 2019 David Wong
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from io import BytesIO
+import argparse
+import datetime
+import resource
+import sys
+import time
+
+from update_users_excel import USER_FIELD_TITLE, UserModel, WorkbookController, WorkbookEngine
+
+ROWS = [10000, 100000, 1000000]
+
+
+def generate_users(count):
+    start = datetime.datetime(2010, 1, 1)
+    for i in range(count):
+        yield {
+            "user_name": f"User{i}",
+            "user_real_name": f"Real Name {i}",
+            "user_email": f"user{i}@domain.tld",
+            "user_registration": start + datetime.timedelta(minutes=i)
+        }
+
+
+def run(engine, rows):
+    """
+    Builds and saves a workbook of `rows` synthetic users. Meant to run in a fresh process, so that the peak memory
+    usage of the process is the peak of this run alone.
+    :param engine:
+    :param rows:
+    :return: Seconds taken and peak memory usage in MiB.
+    """
+
+    user_model = UserModel(field_title=USER_FIELD_TITLE)
+    workbook_controller = WorkbookController()
+    create_users_workbook = (
+        workbook_controller.create_users_workbook_write_only
+        if engine == WorkbookEngine.WRITE_ONLY
+        else workbook_controller.create_users_workbook
+    )
+
+    start = time.perf_counter()
+    with closing(create_users_workbook(
+        user_model.field_title, user_model.fields, user_model.titles, generate_users(rows)
+    )) as workbook:
+        workbook_buffer = BytesIO()
+        workbook.save(workbook_buffer)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mib = peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+    return seconds, peak_mib
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description="Compares the time and peak memory usage of the workbook engines.")
+    parser.add_argument("--rows", help="Numbers of users to benchmark.", type=int, nargs="+", default=ROWS, metavar="N")
+    parser.add_argument("--engines", help="Workbook engines to benchmark.", type=WorkbookEngine, nargs="+", choices=list(WorkbookEngine), default=list(WorkbookEngine))
+    arguments = parser.parse_args(args or None)
+
+    print(f"{'Engine':<12}{'Rows':>10}{'Seconds':>10}{'Peak MiB':>10}")
+    for rows in arguments.rows:
+        for engine in arguments.engines:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                seconds, peak_mib = executor.submit(run, engine, rows).result()
+            print(f"{engine.value:<12}{rows:>10}{seconds:>10.2f}{peak_mib:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,30 +15,62 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from copy import deepcopy
+from itertools import chain
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
 # from pathlib import Path
-from contextlib import closing
-from warnings import warn
-from zipfile import ZipFile, ZIP_DEFLATED
-from io import BytesIO, StringIO
+from contextlib import closing, contextmanager
+from warnings import catch_warnings, simplefilter, warn
+from zipfile import BadZipFile, ZipFile, ZipInfo, ZIP_DEFLATED, sizeFileHeader, stringFileHeader
+from io import BytesIO, DEFAULT_BUFFER_SIZE
 import argparse
 import abc
+import cProfile
+import codecs
 import csv
 import datetime
+import hashlib
+import os
+import sqlite3
+import struct
+import sys
+import time
+import tracemalloc
 import mysql.connector
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
-from openpyxl.styles.numbers import FORMAT_TEXT
+from openpyxl.styles.numbers import FORMAT_GENERAL, FORMAT_TEXT
 from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
 from openpyxl.worksheet.filters import AutoFilter
+from openpyxl.worksheet._writer import WorksheetWriter
 from openpyxl.writer import theme, excel
+from openpyxl.writer.excel import ExcelWriter
 
 import requests
 from urllib3.exceptions import InsecureRequestWarning
 
+# The request metrics, the session cache and the file upload are shared with the other scripts, one directory up. The
+# scripts are not a package, so that directory is appended to the import path, where it cannot shadow an installed
+# module.
+SHARED_MODULES_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SHARED_MODULES_PATH not in sys.path:
+    sys.path.append(SHARED_MODULES_PATH)
+
+from request_metrics import RequestMetrics
+from session_cache import SessionRefresher
+import file_upload
+
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
 
@@ -50,9 +82,28 @@ class ConfigType(Enum):
         return self.value
 
 
+class WorkbookEngine(Enum):
+    DEFAULT = "default"
+    WRITE_ONLY = "write-only"
+
+    def __str__(self):
+        return self.value
+
+
 USERS_EXCEL_FILE_NAME = "Users.xlsx"
 USERS_EXCEL_FILE_PATH = "./" + USERS_EXCEL_FILE_NAME
 
+USER_STORE_PATH = "./Users.sqlite"
+
+UPLOAD_CHUNK_SIZE = 0
+
+WIKI_SESSION_CACHE_PATH = "./Users.session.json"
+
+METRICS_JSON_PATH = ""
+METRICS_PROMETHEUS_PATH = ""
+
+PROFILE_PATH = ""
+
 USER_FIELD_TITLE = OrderedDict([
     ("user_name", "Username"),
     ("user_real_name", "Real name"),
@@ -74,14 +125,73 @@ CONFIG = {
     "wiki_api_path": "/api.php",
     "wiki_username": "Admin",
     "wiki_password": "adminpass",
+    "wiki_session_cache_path": WIKI_SESSION_CACHE_PATH,
     "wiki_user_field_title": USER_FIELD_TITLE,
 
     "config_type": ConfigType.WIKI,
     "users_excel_file_name": USERS_EXCEL_FILE_NAME,
-    "users_excel_file_path": USERS_EXCEL_FILE_PATH
+    "users_excel_file_path": USERS_EXCEL_FILE_PATH,
+    "workbook_engine": WorkbookEngine.DEFAULT,
+    "extra_sheets": False,
+    "processes": 0,
+    "incremental": False,
+    "user_store_path": USER_STORE_PATH,
+    "upload_chunk_size": UPLOAD_CHUNK_SIZE,
+    "force_upload": False,
+    "metrics_json_path": METRICS_JSON_PATH,
+    "metrics_prometheus_path": METRICS_PROMETHEUS_PATH,
+    "profile": PROFILE_PATH,
+    "trace_memory": False
 }
 
 
+class UserTable:
+    """
+    Users stored column by column, with one list per field instead of one dictionary per user, which takes a fraction
+    of the memory and allows whole columns to be converted or measured at once. Iterating over the table yields one
+    dictionary per user, created on the fly.
+    """
+
+    __slots__ = ("fields", "columns")
+
+    def __init__(self, fields, columns=None):
+        self.fields = list(fields)
+        self.columns = (columns if isinstance(columns, dict) else {field: [] for field in self.fields})
+
+    @classmethod
+    def from_rows(cls, fields, rows):
+        table = cls(fields)
+        appends = [table.columns[field].append for field in table.fields]
+        for row in rows:
+            for field, append in zip(table.fields, appends):
+                append(row[field])
+        return table
+
+    @classmethod
+    def from_tuples(cls, fields, rows):
+        table = cls(fields)
+        appends = [table.columns[field].append for field in table.fields]
+        for row in rows:
+            for value, append in zip(row, appends):
+                append(value)
+        return table
+
+    def __len__(self):
+        return (len(self.columns[self.fields[0]]) if self.fields else 0)
+
+    def __iter__(self):
+        fields = self.fields
+        for values in zip(*(self.columns[field] for field in fields)):
+            yield dict(zip(fields, values))
+
+    def map_column(self, field, function):
+        self.columns[field] = list(map(function, self.columns[field]))
+        return self
+
+    def measure_column(self, field, function=len):
+        return max(map(function, self.columns[field]), default=0)
+
+
 class UserModel:
     def __init__(
         self,
@@ -128,15 +238,35 @@ class UserModel:
 
         return field_title, fields, titles
 
-    @staticmethod
-    def format_date(timestamp):
+    TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+    TIMESTAMP_LENGTH = 14
+
+    @classmethod
+    def format_date(cls, timestamp):
         """
         https://www.mediawiki.org/wiki/Manual:Timestamp
-        :param timestamp:
-        :return:
+        The fixed-width format is sliced instead of parsed with `strptime`, which is several times slower.
+        :param timestamp: String or bytes. Users registered before registration dates were recorded have none.
+        :return: datetime, or None if there is no timestamp.
         """
 
-        date = datetime.datetime.strptime(timestamp, "%Y%m%d%H%M%S")
+        if not timestamp:
+            return None
+
+        if isinstance(timestamp, (bytes, bytearray)):
+            timestamp = timestamp.decode("ascii")
+
+        if len(timestamp) != cls.TIMESTAMP_LENGTH:
+            raise ValueError(f"Timestamp {timestamp!r} does not match format {cls.TIMESTAMP_FORMAT!r}.")
+
+        date = datetime.datetime(
+            int(timestamp[0:4]),
+            int(timestamp[4:6]),
+            int(timestamp[6:8]),
+            int(timestamp[8:10]),
+            int(timestamp[10:12]),
+            int(timestamp[12:14])
+        )
         # return date.isoformat()
         return date
 
@@ -151,9 +281,11 @@ class UserModel:
 
     @classmethod
     def format_user_dates(cls, users):
-        for user in users:
-            cls.format_user_registration_date(user)
-        return users
+        return (cls.format_user_registration_date(user) for user in users)
+
+    @classmethod
+    def format_user_table_dates(cls, user_table):
+        return user_table.map_column("user_registration", cls.format_date)
 
 
 class UserController(metaclass=abc.ABCMeta):
@@ -168,8 +300,14 @@ class UserController(metaclass=abc.ABCMeta):
 
     def fetch_formatted_users(self):
         users = self.fetch_users()
-        self.user_model.format_user_dates(users)
-        return users
+        return self.user_model.format_user_dates(users)
+
+    def fetch_user_table(self):
+        return UserTable.from_rows(self.user_model.fields, self.fetch_users())
+
+    def fetch_formatted_user_table(self):
+        user_table = self.fetch_user_table()
+        return self.user_model.format_user_table_dates(user_table)
 
 
 class DatabaseUserModel(UserModel):
@@ -195,6 +333,16 @@ class DatabaseUserModel(UserModel):
             from `{self.table}`;
         """
 
+        # Users are stored with their ID, which is the watermark for fetching only the newer users.
+        self.id_field = "user_id"
+        self.store_fields = [self.id_field] + [field for field in self.fields if field != self.id_field]
+        self.incremental_query = f"""
+            select {", ".join(self.store_fields)}
+            from `{self.table}`
+            where {self.id_field} > %s
+            order by {self.id_field};
+        """
+
 
 class ExportUserModel(UserModel):
     def __init__(
@@ -219,10 +367,82 @@ class DatabaseUserController(UserController):
         super().__init__(database_model.user_model)
 
     def fetch_users(self):
-        return self.database_controller.execute(self.database_model.user_model.query)
+        return self.database_controller.execute_iter(self.database_model.user_model.query)
+
+    def fetch_user_table(self):
+        # Plain tuples go straight into the columns, without a dictionary per row.
+        rows = self.database_controller.execute_iter(self.database_model.user_model.query, dictionary=False)
+        return UserTable.from_tuples(self.database_model.user_model.fields, rows)
+
+    def fetch_users_since(self, user_id):
+        return self.database_controller.execute_iter(self.database_model.user_model.incremental_query, (user_id,))
+
+    def fetch_formatted_users_incrementally(self, user_store_controller):
+        """
+        Adds the users registered since the last run to the user store, and then formats every stored user.
+        :param user_store_controller:
+        :return: Generator of users.
+        """
+
+        user_store_controller.add_users(self.fetch_users_since(user_store_controller.last_user_id()))
+        return self.user_model.format_user_dates(user_store_controller.fetch_users())
+
+
+class UserStoreController:
+    """
+    Local SQLite copy of the user rows, kept between runs so that only the users registered since the last run need
+    to be fetched. The highest stored user ID is the watermark.
+    """
+
+    TABLE = "users"
+
+    def __init__(self, path, id_field, fields):
+        self.path = path
+        self.id_field = id_field
+        self.fields = fields
+        self.store_fields = [id_field] + [field for field in fields if field != id_field]
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+
+        columns = [row[1] for row in connection.execute(f"pragma table_info(`{self.TABLE}`)")]
+        if columns and columns != self.store_fields:
+            # The fields changed since the store was created, so start over with a full fetch.
+            connection.execute(f"drop table `{self.TABLE}`")
+            columns = []
+
+        if not columns:
+            definitions = [f"`{self.id_field}` integer primary key"] + [f"`{field}`" for field in self.store_fields[1:]]
+            connection.execute(f"create table `{self.TABLE}` ({', '.join(definitions)})")
+
+        return connection
+
+    def last_user_id(self):
+        with closing(self.connect()) as connection:
+            (user_id,) = connection.execute(f"select max(`{self.id_field}`) from `{self.TABLE}`").fetchone()
+        return (user_id if user_id is not None else 0)
+
+    def add_users(self, users):
+        store_fields = self.store_fields
+        placeholders = ", ".join("?" for _ in store_fields)
+        with closing(self.connect()) as connection:
+            with connection:
+                connection.executemany(
+                    f"insert or replace into `{self.TABLE}` values ({placeholders})",
+                    ([user[field] for field in store_fields] for user in users)
+                )
+
+    def fetch_users(self):
+        fields = self.fields
+        columns = ", ".join(f"`{field}`" for field in fields)
+        with closing(self.connect()) as connection:
+            for row in connection.execute(f"select {columns} from `{self.TABLE}` order by `{self.id_field}`"):
+                yield dict(zip(fields, row))
 
 
 class ExportUserController(UserController):
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, export_model, export_controller):
         if not isinstance(export_model, ExportModel):
             raise TypeError("`export_model` must be a ExportModel instance.")
@@ -234,7 +454,7 @@ class ExportUserController(UserController):
 
         super().__init__(export_model.user_model)
 
-    def fetch_users_csv(self, token=None):
+    def request_users_csv(self, token=None, stream=False):
         export_model = self.export_model
 
         if not isinstance(token, str):
@@ -247,17 +467,50 @@ class ExportUserController(UserController):
             "wpEditToken": token
         }
 
-        response = self.export_controller.wiki_controller.session.post(url=export_model.user_export_uri, data=body)
+        response = self.export_controller.wiki_controller.session.post(url=export_model.user_export_uri, data=body, stream=stream)
+
+        return response
+
+    def fetch_users_csv(self, token=None):
+        response = self.request_users_csv(token)
 
         data = response.content
 
         return data
 
+    @staticmethod
+    def decode_lines(chunks, encoding="utf-8"):
+        """
+        Decodes a stream of byte chunks into lines, keeping the line endings. The incremental decoder carries over
+        multi-byte characters that are split across chunks.
+        :param chunks:
+        :param encoding:
+        :return: Generator of lines.
+        """
+
+        decoder = codecs.getincrementaldecoder(encoding)()
+        pending = ""
+
+        for chunk in chunks:
+            lines = (pending + decoder.decode(chunk)).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + "\n"
+
+        pending += decoder.decode(b"", final=True)
+        if pending:
+            yield pending
+
     def fetch_users(self):
-        data = self.fetch_users_csv()
-        text = data.decode("utf-8")
-        reader = csv.DictReader(StringIO(text), delimiter=",", quotechar="\"")
-        return list(reader)
+        """
+        Streams the CSV export and yields one user dictionary per row, so only the current row is held in memory.
+        :return: Generator of users.
+        """
+
+        with closing(self.request_users_csv(stream=True)) as response:
+            lines = self.decode_lines(response.iter_content(chunk_size=self.CHUNK_SIZE))
+            reader = csv.DictReader(lines, delimiter=",", quotechar="\"")
+            yield from reader
 
 
 class DatabaseConfigModel:
@@ -332,15 +585,29 @@ class WikiConfigModel:
 
 
 class WikiController:
-    def __init__(self, wiki_config_model):
+    def __init__(self, wiki_config_model, session_cache_path=None, request_metrics=None):
         if not isinstance(wiki_config_model, WikiConfigModel):
             raise TypeError("`wiki_config_model` must be a WikiConfigModel instance.")
         self.config_model = wiki_config_model
+        self.session_cache_path = session_cache_path
 
         session = requests.Session()
         session.verify = False
         self.session = session
 
+        if request_metrics is not None and not isinstance(request_metrics, RequestMetrics):
+            raise TypeError("`request_metrics` must be a RequestMetrics instance.")
+        self.request_metrics = request_metrics
+        if request_metrics is not None:
+            request_metrics.install(session)
+
+        self.session_refresher = SessionRefresher(
+            session,
+            lambda option: self.login(option["token"], option["return_uri"]),
+            self.fetch_tokens,
+            self.record_retry
+        )
+
         self.current_login_token = None
         self.current_csrf_token = None
 
@@ -375,12 +642,46 @@ class WikiController:
 
     @property
     def csrf_token(self):
+        session_refresher = self.session_refresher
+        if session_refresher.generation:
+            return session_refresher.fetch_refreshed_token("csrf")
+
         token = self.current_csrf_token
         if not isinstance(token, str):
             token = self.fetch_csrf_token()
             self.current_csrf_token = token
+            session_refresher.save_session(token)
         return token
 
+    def resume_session_or_login(self):
+        """
+        Resumes the cached session if the wiki still accepts it, or logs in and caches the new session.
+        :return: Session cache if the cached session was resumed, or None.
+        """
+
+        config_model = self.config_model
+        session_cache = self.session_refresher.resume_session_or_login(config_model.api_endpoint, {
+            "username": config_model.username,
+            "password": config_model.password,
+            "return_uri": config_model.uri,
+            "session_cache_path": self.session_cache_path
+        })
+
+        self.current_login_token = None
+        self.current_csrf_token = (session_cache.get("csrf_token") if session_cache is not None else None)
+
+        return session_cache
+
+    def record_retry(self, action, reason):
+        if self.request_metrics is not None:
+            self.request_metrics.record_retry(action, reason)
+
+    def post(self, body, files=None):
+        return self.session.post(url=self.config_model.api_endpoint, files=files, data=body)
+
+    def post_with_csrf_token(self, body, files=None):
+        return self.session_refresher.post_with_token(self.post, body, "csrf", files=files)
+
     def login(self, token=None, return_uri=None):
         config_model = self.config_model
         username = config_model.username
@@ -407,35 +708,55 @@ class WikiController:
 
         return data
 
-    def upload_file(self, file_name, file_data, token=None):
-        if not isinstance(token, str):
-            token = self.csrf_token
-
+    def fetch_file_sha1(self, file_name):
         body = {
-            "action": "upload",
-            "filename": file_name,
-            "token": token,
-            "format": "json",
-            "ignorewarnings": 1
+            "action": "query",
+            "prop": "imageinfo",
+            "iiprop": "sha1",
+            "titles": f"File:{file_name}",
+            "format": "json"
         }
 
-        files = {
-            "file": (file_name, file_data, "multipart/form-data")
-        }
+        response = self.session.get(url=self.config_model.api_endpoint, params=body)
+        data = response.json()
 
-        response = self.session.post(url=self.config_model.api_endpoint, files=files, data=body)
+        for page in data.get("query", {}).get("pages", {}).values():
+            image_info = page.get("imageinfo")
+            if image_info:
+                return image_info[0]["sha1"]
 
-        data = None
+        return None
 
-        try:
-            data = response.json()
+    def upload_file(self, file_name, file_data, token=None):
+        if not isinstance(token, str):
+            token = self.csrf_token
 
-            print(data)
-        except ValueError:
-            print(response)
-            print(response.content)
+        return file_upload.upload_file(self.post_with_csrf_token, {"name": file_name, "data": file_data, "token": token})
 
-        return data
+    def upload_file_in_chunks(self, file_name, file_path, chunk_size, token=None, filekey=None, offset=0):
+        """
+        Uploads the file in chunks with `file_upload.upload_file_in_chunks`. To resume an earlier upload, pass its
+        `filekey` and `offset`.
+        :param file_name:
+        :param file_path:
+        :param chunk_size: Chunk size in bytes.
+        :param token:
+        :param filekey:
+        :param offset:
+        :return: The response data of the final upload, or of the first chunk the wiki rejected.
+        """
+
+        if not isinstance(token, str):
+            token = self.csrf_token
+
+        return file_upload.upload_file_in_chunks(self.post_with_csrf_token, {
+            "name": file_name,
+            "path": file_path,
+            "token": token,
+            "chunk_size": chunk_size,
+            "filekey": filekey,
+            "offset": offset
+        }, self.record_retry)
 
 
 class ExportModel:
@@ -472,6 +793,8 @@ class ExportModel:
 
 
 class DatabaseController:
+    FETCH_BATCH_SIZE = 1000
+
     def __init__(self, database_model, wiki_controller=None):
         self.config_type = ConfigType.DATABASE
 
@@ -481,28 +804,63 @@ class DatabaseController:
 
         self.database_user_controller = DatabaseUserController(database_model, self)
 
-    def execute(self, query):
+    def connect(self, **kwargs):
         config_model = self.database_model.config_model
-        rows = []
-        with closing(mysql.connector.connect(
+        return mysql.connector.connect(
             user=config_model.username,
             password=config_model.password,
             host=config_model.host,
             port=config_model.port,
-            database=config_model.database
-        )) as connection:
+            database=config_model.database,
+            **kwargs
+        )
+
+    def execute(self, query):
+        with closing(self.connect()) as connection:
             with closing(connection.cursor(dictionary=True)) as cursor:
                 cursor.execute(query)
-                result = cursor.fetchall()
-                rows = list(result)
+                rows = cursor.fetchall()
         return rows
 
+    def execute_iter(self, query, params=None, batch_size=None, dictionary=True):
+        """
+        Runs the query with an unbuffered cursor and yields the rows as the server sends them, fetching
+        `batch_size` rows at a time, so memory stays flat however many rows the query returns.
+        :param query:
+        :param params:
+        :param batch_size:
+        :param dictionary: Whether to yield dictionaries instead of tuples.
+        :return: Generator of rows.
+        """
+
+        if batch_size is None:
+            batch_size = self.FETCH_BATCH_SIZE
+
+        # Unread rows are discarded if the generator is closed early.
+        with closing(self.connect(consume_results=True)) as connection:
+            with closing(connection.cursor(dictionary=dictionary, buffered=False)) as cursor:
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+
     def fetch_users(self):
         return self.database_user_controller.fetch_users()
 
     def fetch_formatted_users(self):
         return self.database_user_controller.fetch_formatted_users()
 
+    def fetch_user_table(self):
+        return self.database_user_controller.fetch_user_table()
+
+    def fetch_formatted_user_table(self):
+        return self.database_user_controller.fetch_formatted_user_table()
+
+    def fetch_formatted_users_incrementally(self, user_store_controller):
+        return self.database_user_controller.fetch_formatted_users_incrementally(user_store_controller)
+
 
 class ExportController:
     def __init__(self, export_model, wiki_controller=None):
@@ -514,8 +872,11 @@ class ExportController:
 
         self.export_user_controller = ExportUserController(export_model, self)
 
-        self.wiki_controller = (wiki_controller if isinstance(wiki_controller, WikiController) else WikiController(export_model.wiki_model))
-        wiki_controller.login()
+        # A wiki controller that is passed in is logged in by its owner, which may have resumed a cached session.
+        if not isinstance(wiki_controller, WikiController):
+            wiki_controller = WikiController(export_model.wiki_model)
+            wiki_controller.resume_session_or_login()
+        self.wiki_controller = wiki_controller
 
     def fetch_users(self):
         return self.export_user_controller.fetch_users()
@@ -523,6 +884,34 @@ class ExportController:
     def fetch_formatted_users(self):
         return self.export_user_controller.fetch_formatted_users()
 
+    def fetch_user_table(self):
+        return self.export_user_controller.fetch_user_table()
+
+    def fetch_formatted_user_table(self):
+        return self.export_user_controller.fetch_formatted_user_table()
+
+
+class WorksheetModel:
+    def __init__(
+        self,
+        title,
+        table_name,
+        field_title,
+        rows,
+        total_row,
+        total_function="count"
+    ):
+        self.title = title
+        self.table_name = table_name
+
+        self.field_title = field_title
+        self.fields = list(field_title.keys())
+        self.titles = list(field_title.values())
+
+        self.rows = rows
+        self.total_row = total_row
+        self.total_function = total_function
+
 
 class WorkbookController:
     XL_FOLDER_NAME = "xl"
@@ -538,6 +927,21 @@ class WorkbookController:
     ]
 
     ISO_8601_NUMBER_FORMAT = "yyyy-mm-ddThh:MM:ss"
+    ISO_8601_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+    REGISTRATIONS_BY_MONTH_FIELD_TITLE = OrderedDict([
+        ("month", "Month"),
+        ("users", "Users")
+    ])
+
+    EMAIL_DOMAINS_FIELD_TITLE = OrderedDict([
+        ("domain", "Email domain"),
+        ("users", "Users")
+    ])
+
+    # Fixed timestamps for the document properties and zip entries, so that the same users give the same bytes.
+    PROPERTIES_DATE_TIME = datetime.datetime(1980, 1, 1)
+    ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
     was_theme_updated = False
 
@@ -569,79 +973,151 @@ class WorkbookController:
         theme.theme_xml = xml
         excel.theme_xml = xml
 
+    @staticmethod
+    def copy_zip_member(zip_file, target_zip_file, info, date_time=None):
+        """
+        Copies a member's compressed data as is, without inflating and deflating it again.
+        :param zip_file: Source zip file.
+        :param target_zip_file: Zip file opened for writing.
+        :param info: ZipInfo of the member in the source zip file.
+        :param date_time: Modification time of the copy. Defaults to the one of the source member.
+        :return:
+        """
+
+        source = zip_file.fp
+        source.seek(info.header_offset)
+        header = source.read(sizeFileHeader)
+        if header[:4] != stringFileHeader:
+            raise BadZipFile(f"Bad local file header for {info.filename}.")
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        source.seek(info.header_offset + sizeFileHeader + name_length + extra_length)
+
+        target_info = ZipInfo(info.filename, date_time or info.date_time)
+        target_info.compress_type = info.compress_type
+        target_info.create_system = info.create_system
+        target_info.external_attr = info.external_attr
+        # The sizes and CRC are known, so they go in the local header instead of a data descriptor.
+        target_info.flag_bits = info.flag_bits & ~0x08
+        target_info.CRC = info.CRC
+        target_info.compress_size = info.compress_size
+        target_info.file_size = info.file_size
+
+        target = target_zip_file.fp
+        target_info.header_offset = target.tell()
+        target.write(target_info.FileHeader())
+
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = source.read(min(remaining, DEFAULT_BUFFER_SIZE))
+            if not chunk:
+                raise BadZipFile(f"Truncated data for {info.filename}.")
+            target.write(chunk)
+            remaining -= len(chunk)
+
+        target_zip_file.filelist.append(target_info)
+        target_zip_file.NameToInfo[target_info.filename] = target_info
+        target_zip_file.start_dir = target.tell()
+
     @classmethod
     def fix_workbook_mime_type(cls, file_path):
+        """
+        Moves the parts that identify the package as a workbook to the front of the zip file. The members are copied
+        in their compressed form, so nothing is inflated or deflated again, and get a fixed modification time.
+        :param file_path: Path or file object of the workbook.
+        :return: BytesIO with the fixed workbook.
+        """
+
         buffer = BytesIO()
 
         with ZipFile(file_path) as zip_file:
-            names = zip_file.namelist()
-
             FIRST_NAMES = cls.FIRST_NAMES
-            remaining_names = [name for name in names if name not in FIRST_NAMES]
-            ordered_names = FIRST_NAMES + remaining_names
+            infos = zip_file.infolist()
+            first_infos = [info for name in FIRST_NAMES for info in infos if info.filename == name]
+            remaining_infos = [info for info in infos if info.filename not in FIRST_NAMES]
 
             with ZipFile(buffer, "w", ZIP_DEFLATED, allowZip64=True) as buffer_zip_file:
-                for name in ordered_names:
-                    try:
-                        file = zip_file.open(name)
-                        buffer_zip_file.writestr(file.name, file.read())
-                    except KeyError:
-                        pass
+                for info in first_infos + remaining_infos:
+                    cls.copy_zip_member(zip_file, buffer_zip_file, info, cls.ZIP_DATE_TIME)
 
         return buffer
 
-    @staticmethod
-    def autosize_columns(worksheet):
-        def value_of(value):
-            return (str(value) if value is not None else "")
+    @classmethod
+    def save_workbook(cls, workbook, file):
+        """
+        Saves the workbook like `Workbook.save`, but with fixed creation and modification times instead of the
+        current time.
+        :param workbook:
+        :param file: Path or file object.
+        :return:
+        """
+
+        properties = workbook.properties
+        properties.created = cls.PROPERTIES_DATE_TIME
+        properties.modified = cls.PROPERTIES_DATE_TIME
+
+        with ZipFile(file, "w", ZIP_DEFLATED, allowZip64=True) as archive:
+            ExcelWriter(workbook, archive).save()
+
+    @classmethod
+    def display_text(cls, value):
+        """
+        Text that Excel displays for a cell value, for measuring column widths.
+        :param value:
+        :return:
+        """
+
+        if value is None:
+            return ""
+        if isinstance(value, datetime.datetime):
+            return value.strftime(cls.ISO_8601_DATE_FORMAT)
+        return str(value)
 
+    @classmethod
+    def autosize_columns(cls, worksheet):
         for cells in worksheet.columns:
-            length = max(len(value_of(cell.value)) for cell in cells)
+            length = max(len(cls.display_text(cell.value)) for cell in cells)
             column_letter = get_column_letter(cells[0].column)
             worksheet.column_dimensions[column_letter].width = length
 
         return worksheet
 
     @classmethod
-    def create_users_workbook(cls, field_title, fields, titles, users):
-        # Initialize workbook and worksheet.
-        workbook = Workbook()
-        properties = workbook.properties
-        properties.title = "Users"
-        properties.creator = None
-
-        sheet = workbook.active
-        sheet.title = "Users"
+    def track_column_widths(cls, widths, values):
+        for c, value in enumerate(values):
+            length = len(cls.display_text(value))
+            if length > widths[c]:
+                widths[c] = length
 
-        table_name = "User"
-
-        # Add data.
-        rows = [field_title] + users
-        for r, row in enumerate(rows, start=1):
-            for c, field in enumerate(fields, start=1):
-                value = row[field]
-                cell = sheet.cell(row=r, column=c)
-
-                cell_number_format = FORMAT_TEXT
-                cell_value = value
-                cell_data_type = "s"
-                if isinstance(value, datetime.datetime):
-                    cell_number_format = cls.ISO_8601_NUMBER_FORMAT
-                    cell_data_type = "d"
+    @staticmethod
+    def set_column_widths(worksheet, widths):
+        for c, width in enumerate(widths, start=1):
+            worksheet.column_dimensions[get_column_letter(c)].width = width
 
-                cell.number_format = cell_number_format
-                cell.value = cell_value
-                cell.data_type = cell_data_type
+    @classmethod
+    def format_cell(cls, value):
+        if isinstance(value, datetime.datetime):
+            return cls.ISO_8601_NUMBER_FORMAT, "d"
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return FORMAT_GENERAL, "n"
+        return FORMAT_TEXT, "s"
 
+    @staticmethod
+    def create_total_row(fields, titles, table_name):
         total_row = {
             "user_name": "Total",
             "user_real_name": "",
             "user_email": "",
             "user_registration": f"=SUBTOTAL(103,{table_name}[{titles[-1]}])"
         }
-        sheet.append([total_row[field] for field in fields])
+        return [total_row[field] for field in fields]
 
-        # Add table.
+    @staticmethod
+    def total_row_labels(total_row):
+        # The formulas display small counts, so only the labels count towards the column widths.
+        return [(None if isinstance(value, str) and value.startswith("=") else value) for value in total_row]
+
+    @staticmethod
+    def create_table(titles, table_name, max_column, max_row, total_function="count"):
         style = TableStyleInfo(
             name="TableStyleMedium2",
             showFirstColumn=False,
@@ -654,11 +1130,9 @@ class WorkbookController:
         total_column = table_columns[0]
         total_column.totalsRowLabel = "Total"
         count_column = table_columns[-1]
-        count_column.totalsRowFunction = "count"
+        count_column.totalsRowFunction = total_function
 
-        max_column = sheet.max_column
         max_column_letter = get_column_letter(max_column)
-        max_row = sheet.max_row
         table = Table(
             displayName=table_name,
             ref=f"A1:{max_column_letter}{max_row}",
@@ -669,19 +1143,475 @@ class WorkbookController:
             tableColumns=table_columns
         )
 
-        sheet.add_table(table)
+        return table
+
+    @staticmethod
+    def add_write_only_table(worksheet, table):
+        # openpyxl warns that write-only tables need their columns added manually, which they are.
+        with catch_warnings():
+            simplefilter("ignore", UserWarning)
+            worksheet.add_table(table)
+
+    @staticmethod
+    def select_cell(worksheet, cell):
+        selection = worksheet.sheet_view.selection[0]
+        selection.activeCell = cell
+        selection.sqref = cell
+
+    @classmethod
+    def create_users_workbook(cls, field_title, fields, titles, users):
+        # Initialize workbook and worksheet.
+        workbook = Workbook()
+        properties = workbook.properties
+        properties.title = "Users"
+        properties.creator = None
+
+        sheet = workbook.active
+        sheet.title = "Users"
+
+        table_name = "User"
+
+        # Add data, keeping track of the widest value of each column.
+        widths = [0] * len(fields)
+        rows = chain([field_title], users)
+        for r, row in enumerate(rows, start=1):
+            values = [row[field] for field in fields]
+            cls.track_column_widths(widths, values)
+            for c, value in enumerate(values, start=1):
+                cell = sheet.cell(row=r, column=c)
+
+                cell_number_format, cell_data_type = cls.format_cell(value)
+
+                cell.number_format = cell_number_format
+                cell.value = value
+                cell.data_type = cell_data_type
+
+        total_row = cls.create_total_row(fields, titles, table_name)
+        cls.track_column_widths(widths, cls.total_row_labels(total_row))
+        sheet.append(total_row)
+
+        # Add table.
+        max_row = sheet.max_row
+        sheet.add_table(cls.create_table(titles, table_name, sheet.max_column, max_row))
 
         # Adjust column sizes.
-        cls.autosize_columns(sheet)
+        cls.set_column_widths(sheet, widths)
 
         # Set the active cell under the table.
-        active_cell = f"A{max_row + 1}"
-        selection = sheet.sheet_view.selection[0]
-        selection.activeCell = active_cell
-        selection.sqref = active_cell
+        cls.select_cell(sheet, f"A{max_row + 1}")
+
+        return workbook
+
+    @staticmethod
+    def get_write_only_worksheet_path(worksheet):
+        """
+        openpyxl has no public way to get at the file a write-only worksheet streams its XML to, so this is the one
+        place that reaches into the worksheet's writer for it. See requirements.txt for the versions this is tested
+        with.
+        :param worksheet: Closed write-only worksheet.
+        :return: Path of the worksheet XML file.
+        """
+
+        writer = getattr(worksheet, "_writer", None)
+        path = getattr(writer, "out", None)
+        if not isinstance(path, str) or not os.path.isfile(path):
+            raise RuntimeError(f"Cannot find the XML file of the worksheet {worksheet.title!r} with this openpyxl version.")
+        return path
+
+    @classmethod
+    def rewrite_write_only_worksheet_top(cls, worksheet):
+        """
+        A write-only worksheet writes its views and columns before the first row, when the number of rows and the
+        column widths are not known yet. Once the worksheet is closed, this writes its top again from the current
+        settings and splices it onto the rows already streamed to the worksheet's temporary file.
+
+        Only the elements between the root start tag and the sheet data are replaced. The root start tag is kept from
+        the streamed file, because it declares the namespaces of the elements after the sheet data, such as the `r`
+        prefix of the table parts, which some versions of et_xmlfile declare on the root instead of on the element.
+        :param worksheet: Closed write-only worksheet.
+        :return:
+        """
+
+        top_writer = WorksheetWriter(worksheet, out=BytesIO())
+        top_writer.write_top()
+        top_writer.xf.close()
+        top = top_writer.out.getvalue()
+        top = top[top.index(b">", top.index(b"<worksheet")) + 1:top.rindex(b"</worksheet>")]
+
+        path = cls.get_write_only_worksheet_path(worksheet)
+        with open(path, "rb") as source:
+            head = b""
+            while b"<sheetData" not in head:
+                chunk = source.read(DEFAULT_BUFFER_SIZE)
+                if not chunk:
+                    raise ValueError("Worksheet has no sheet data.")
+                head += chunk
+
+            with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as target:
+                target.write(head[:head.index(b">", head.index(b"<worksheet")) + 1])
+                target.write(top)
+                target.write(head[head.index(b"<sheetData"):])
+                copyfileobj(source, target)
+
+        os.replace(target.name, path)
+
+    @classmethod
+    def write_table_worksheet(cls, worksheet, worksheet_model):
+        """
+        Streams the rows of the worksheet model into a write-only worksheet as a table with a totals row, and closes
+        the worksheet.
+        :param worksheet: Write-only worksheet.
+        :param worksheet_model:
+        :return: Number of rows written, including the header and totals rows.
+        """
+
+        fields = worksheet_model.fields
+        titles = worksheet_model.titles
+        table_name = worksheet_model.table_name
+
+        # Add data, keeping track of the widest value of each column.
+        widths = [0] * len(fields)
+        rows = chain([worksheet_model.field_title], worksheet_model.rows)
+        max_row = 0
+        for max_row, row in enumerate(rows, start=1):
+            values = [row[field] for field in fields]
+            cls.track_column_widths(widths, values)
+            cells = []
+            for value in values:
+                cell = WriteOnlyCell(worksheet, value=value)
+
+                cell_number_format, cell_data_type = cls.format_cell(value)
+
+                cell.number_format = cell_number_format
+                cell.data_type = cell_data_type
+                cells.append(cell)
+            worksheet.append(cells)
+
+        total_row = worksheet_model.total_row
+        cls.track_column_widths(widths, cls.total_row_labels(total_row))
+        worksheet.append(total_row)
+        max_row += 1
+
+        # Add table.
+        cls.add_write_only_table(worksheet, cls.create_table(
+            titles, table_name, len(fields), max_row, worksheet_model.total_function
+        ))
+
+        # Adjust column sizes. They are written out when the worksheet's top is rewritten.
+        cls.set_column_widths(worksheet, widths)
+
+        # Set the active cell under the table.
+        cls.select_cell(worksheet, f"A{max_row + 1}")
+
+        worksheet.close()
+        cls.rewrite_write_only_worksheet_top(worksheet)
+
+        return max_row
+
+    @classmethod
+    def create_users_worksheet_model(cls, field_title, fields, titles, users):
+        table_name = "User"
+        return WorksheetModel(
+            "Users", table_name, field_title, users, cls.create_total_row(fields, titles, table_name)
+        )
+
+    @classmethod
+    def create_users_workbook_write_only(cls, field_title, fields, titles, users):
+        """
+        Creates the same workbook as `create_users_workbook` with openpyxl's write-only mode, which streams each row to
+        a temporary file as it is appended instead of keeping a cell object per value.
+        :param field_title:
+        :param fields:
+        :param titles:
+        :param users: Iterable of users, which is consumed once.
+        :return:
+        """
+
+        # Initialize workbook and worksheet.
+        workbook = Workbook(write_only=True)
+        properties = workbook.properties
+        properties.title = "Users"
+        properties.creator = None
+
+        sheet = workbook.create_sheet("Users")
+
+        cls.write_table_worksheet(sheet, cls.create_users_worksheet_model(field_title, fields, titles, users))
 
         return workbook
 
+    @staticmethod
+    def create_count_worksheet_model(title, table_name, field_title, counts):
+        key_field, count_field = field_title.keys()
+        count_title = field_title[count_field]
+        rows = [{key_field: key, count_field: count} for key, count in sorted(counts.items())]
+        total_row = ["Total", f"=SUBTOTAL(109,{table_name}[{count_title}])"]
+        return WorksheetModel(title, table_name, field_title, rows, total_row, total_function="sum")
+
+    @classmethod
+    def create_registrations_by_month_worksheet_model(cls, user_table):
+        def month_of(date):
+            return (date.strftime("%Y-%m") if isinstance(date, datetime.datetime) else "Unknown")
+
+        counts = Counter(map(month_of, user_table.columns["user_registration"]))
+        return cls.create_count_worksheet_model(
+            "Registrations by month", "RegistrationsByMonth", cls.REGISTRATIONS_BY_MONTH_FIELD_TITLE, counts
+        )
+
+    @classmethod
+    def create_email_domains_worksheet_model(cls, user_table):
+        def domain_of(email):
+            if isinstance(email, (bytes, bytearray)):
+                email = email.decode("utf-8", "replace")
+            if not email or "@" not in email:
+                return "(none)"
+            return email.rpartition("@")[2].lower()
+
+        counts = Counter(map(domain_of, user_table.columns["user_email"]))
+        return cls.create_count_worksheet_model(
+            "Email domains", "EmailDomains", cls.EMAIL_DOMAINS_FIELD_TITLE, counts
+        )
+
+    @classmethod
+    def register_cell_styles(cls, worksheet):
+        """
+        Registers the cell styles of `format_cell` with the workbook of the worksheet in a fixed order. Cells refer to
+        styles by their index in the workbook, so worksheets rendered in different workbooks agree on the indices.
+        :param worksheet: Write-only worksheet.
+        :return:
+        """
+
+        for value in ("", datetime.datetime(1980, 1, 1), 0):
+            cell = WriteOnlyCell(worksheet, value=value)
+            cell.number_format, cell.data_type = cls.format_cell(value)
+            # Reading the style ID adds the cell's style to the workbook.
+            cell.style_id
+
+    @classmethod
+    def render_worksheet(cls, worksheet_model):
+        """
+        Writes the worksheet XML of the worksheet model. Runs in a worker process.
+        :param worksheet_model:
+        :return: Path of the worksheet XML file, which the caller must move or remove, and the number of rows.
+        """
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(worksheet_model.title)
+        cls.register_cell_styles(sheet)
+        max_row = cls.write_table_worksheet(sheet, worksheet_model)
+
+        # openpyxl removes its temporary files when the worker process exits, so move the worksheet out of them.
+        with NamedTemporaryFile(prefix="worksheet.", suffix=".xml", delete=False) as file:
+            path = file.name
+        os.replace(cls.get_write_only_worksheet_path(sheet), path)
+
+        return path, max_row
+
+    @classmethod
+    def create_multi_sheet_users_workbook(cls, field_title, fields, titles, user_table, processes=None):
+        """
+        Creates a workbook with the users sheet and the registrations by month and email domains sheets. Each
+        worksheet is rendered in its own process of a process pool, and the results are assembled into one workbook.
+        :param field_title:
+        :param fields:
+        :param titles:
+        :param user_table: UserTable, which is read more than once.
+        :param processes: Number of worker processes. Defaults to the number of CPUs.
+        :return:
+        """
+
+        worksheet_models = [
+            cls.create_users_worksheet_model(field_title, fields, titles, user_table),
+            cls.create_registrations_by_month_worksheet_model(user_table),
+            cls.create_email_domains_worksheet_model(user_table)
+        ]
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            rendered = list(executor.map(cls.render_worksheet, worksheet_models))
+
+        try:
+            # Initialize workbook.
+            workbook = Workbook(write_only=True)
+            properties = workbook.properties
+            properties.title = "Users"
+            properties.creator = None
+
+            # Each worksheet gets the same table as its rendered XML, which sets up the table part and its
+            # relationship, and then the rendered XML replaces the empty worksheet.
+            for worksheet_model, (path, max_row) in zip(worksheet_models, rendered):
+                sheet = workbook.create_sheet(worksheet_model.title)
+                cls.register_cell_styles(sheet)
+                cls.add_write_only_table(sheet, cls.create_table(
+                    worksheet_model.titles, worksheet_model.table_name, len(worksheet_model.fields), max_row,
+                    worksheet_model.total_function
+                ))
+                sheet.close()
+                os.replace(path, cls.get_write_only_worksheet_path(sheet))
+        finally:
+            for path, max_row in rendered:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        return workbook
+
+
+class StageProfileModel:
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.rss = None
+        self.peak_rss = None
+        self.traced_peak = None
+
+
+class StageProfileController:
+    """
+    Times the stages of a run with `time.perf_counter` and samples the memory after each top-level stage. A stage
+    entered inside another stage is subtracted from it, so every stage only counts its own time. Users are streamed
+    through the stages, so `iterate` times each step of an iterator as a stage of its own.
+
+    The resident set size is always sampled. With `trace_memory`, the peak of the memory allocated by Python is also
+    tracked with `tracemalloc`, which slows the run down.
+    """
+
+    MEBIBYTE = 1024 * 1024
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.models = OrderedDict()
+        # [model, start, elapsed of the nested stages] of each stage entered and not exited yet.
+        self.stack = []
+        self.started = None
+        self.elapsed = 0.0
+
+    @staticmethod
+    def get_rss():
+        """
+        :return: Resident set size in bytes, or None if it cannot be read on this platform.
+        """
+
+        try:
+            with open("/proc/self/statm") as file:
+                pages = int(file.read().split()[1])
+            return pages * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    @staticmethod
+    def get_peak_rss():
+        """
+        :return: Peak resident set size in bytes, or None if it cannot be read on this platform.
+        """
+
+        if resource is None:
+            return None
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS.
+        return (peak_rss if sys.platform == "darwin" else peak_rss * 1024)
+
+    @staticmethod
+    def reset_traced_peak():
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            # Python < 3.9 only resets the peak along with the traces.
+            tracemalloc.clear_traces()
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def get_model(self, name):
+        model = self.models.get(name)
+        if model is None:
+            model = self.models[name] = StageProfileModel(name)
+        return model
+
+    def enter(self, name):
+        if not self.stack and self.trace_memory:
+            self.reset_traced_peak()
+        self.stack.append([self.get_model(name), time.perf_counter(), 0.0])
+
+    def exit(self):
+        model, start, nested_elapsed = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        model.elapsed += elapsed - nested_elapsed
+
+        if self.stack:
+            self.stack[-1][2] += elapsed
+            return
+
+        model.rss = self.get_rss()
+        model.peak_rss = self.get_peak_rss()
+        if self.trace_memory:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            model.traced_peak = max(model.traced_peak or 0, traced_peak)
+
+    @contextmanager
+    def stage(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def iterate(self, name, iterable):
+        """
+        :param name: Stage name.
+        :param iterable:
+        :return: Generator of the items of `iterable`, which times the stage each time it gets an item.
+        """
+
+        iterator = iter(iterable)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def format_mebibytes(self, value):
+        return ("" if value is None else f"{value / self.MEBIBYTE:.1f}")
+
+    def format_summary(self):
+        """
+        :return: Table of the time and the memory of each stage, in the order the stages were first entered.
+        """
+
+        total = self.elapsed or sum(model.elapsed for model in self.models.values())
+
+        header = ["Stage", "Time s", "%", "RSS MiB", "Peak RSS MiB"]
+        if self.trace_memory:
+            header.append("Traced peak MiB")
+        rows = [header]
+        for model in chain(self.models.values(), [None]):
+            elapsed = (model.elapsed if model is not None else total)
+            row = [
+                (model.name if model is not None else "total"),
+                f"{elapsed:.3f}",
+                f"{(100 * elapsed / total if total else 0):.1f}",
+                self.format_mebibytes(model.rss if model is not None else self.get_rss()),
+                self.format_mebibytes(model.peak_rss if model is not None else self.get_peak_rss())
+            ]
+            if self.trace_memory:
+                row.append(self.format_mebibytes(model.traced_peak if model is not None else None))
+            rows.append(row)
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return "\n".join(
+            "  ".join((value.ljust(width) if i == 0 else value.rjust(width)) for i, (value, width) in enumerate(zip(row, widths)))
+            for row in rows
+        )
+
 
 class ArgumentController:
     def __init__(self, default_config):
@@ -691,7 +1621,7 @@ class ArgumentController:
 
     @staticmethod
     def add_argument(parser, *args, **kwargs):
-        if "metavar" not in kwargs and "choices" not in kwargs and "default" in kwargs:
+        if "metavar" not in kwargs and "choices" not in kwargs and "action" not in kwargs and "default" in kwargs:
             kwargs["metavar"] = kwargs["default"]
         parser.add_argument(*args, **kwargs)
 
@@ -724,13 +1654,25 @@ class ArgumentController:
             (["--wiki-uri", "--w-uri"], {"help": "Wiki URI.", "default": config["wiki_uri"]}),
             (["--wiki-api-path", "--w-api-path"], {"help": "Wiki API path.", "default": config["wiki_api_path"]}),
             (["--wiki-username", "--w-username", "--w-user"], {"help": "Wiki username.", "default": config["wiki_username"]}),
-            (["--wiki-password", "--w-password", "--w-pass"], {"help": "Wiki password.", "default": config["wiki_password"]})
+            (["--wiki-password", "--w-password", "--w-pass"], {"help": "Wiki password.", "default": config["wiki_password"]}),
+            (["--wiki-session-cache-path", "--w-session-cache-path"], {"help": "Wiki session cache path. The session is reused by later runs until it expires. Disabled if empty.", "default": config["wiki_session_cache_path"]})
         ])
 
         add_arguments(parser, [
             (["--config-type"], {"help": "Config type.", "type": ConfigType, "choices": list(ConfigType), "default": config["config_type"]}),
             (["--users-excel-file-name"], {"help": "Users Excel file name.", "default": config["users_excel_file_name"]}),
-            (["--users-excel-file-path"], {"help": "Users Excel file path.", "default": config["users_excel_file_path"]})
+            (["--users-excel-file-path"], {"help": "Users Excel file path.", "default": config["users_excel_file_path"]}),
+            (["--workbook-engine"], {"help": "Workbook engine. The write-only engine streams rows to disk and uses much less memory.", "type": WorkbookEngine, "choices": list(WorkbookEngine), "default": config["workbook_engine"]}),
+            (["--extra-sheets"], {"help": "Add registrations by month and email domain sheets. Each sheet is rendered in its own process.", "action": "store_true", "default": config["extra_sheets"]}),
+            (["--processes"], {"help": "Number of processes for rendering sheets. Defaults to the number of CPUs if 0.", "type": int, "default": config["processes"]}),
+            (["--incremental"], {"help": "Only fetch the users registered since the last run and merge them into the user store. Database config type only.", "action": "store_true", "default": config["incremental"]}),
+            (["--user-store-path"], {"help": "User store path, for incremental runs.", "default": config["user_store_path"]}),
+            (["--upload-chunk-size"], {"help": "Upload chunk size in bytes. The file is uploaded in a single request if 0.", "type": int, "default": config["upload_chunk_size"]}),
+            (["--force-upload"], {"help": "Upload the workbook even if the wiki already has the same file.", "action": "store_true", "default": config["force_upload"]}),
+            (["--metrics-json-path"], {"help": "Write the wiki request metrics to this JSON file. Disabled if empty.", "default": config["metrics_json_path"]}),
+            (["--metrics-prometheus-path"], {"help": "Write the wiki request metrics to this Prometheus textfile collector file, such as ./users.prom. Disabled if empty.", "default": config["metrics_prometheus_path"]}),
+            (["--profile"], {"help": "Write the cProfile stats of the run to this path, for pstats. Disabled if empty.", "default": config["profile"]}),
+            (["--trace-memory"], {"help": "Track the peak memory allocated by Python in each stage with tracemalloc. Slows the run down.", "action": "store_true", "default": config["trace_memory"]})
         ])
 
         self.parser = parser
@@ -778,9 +1720,22 @@ class ConfigModel:
             "user_field_title": config["wiki_user_field_title"]
         }
 
+        self.wiki_session_cache_path = config["wiki_session_cache_path"]
+
         self.config_type = config["config_type"]
         self.users_excel_file_name = config["users_excel_file_name"]
         self.users_excel_file_path = config["users_excel_file_path"]
+        self.workbook_engine = config["workbook_engine"]
+        self.extra_sheets = config["extra_sheets"]
+        self.processes = config["processes"]
+        self.incremental = config["incremental"]
+        self.user_store_path = config["user_store_path"]
+        self.upload_chunk_size = config["upload_chunk_size"]
+        self.force_upload = config["force_upload"]
+        self.metrics_json_path = config["metrics_json_path"]
+        self.metrics_prometheus_path = config["metrics_prometheus_path"]
+        self.profile_path = config["profile"]
+        self.trace_memory = config["trace_memory"]
 
 
 class MainController:
@@ -791,25 +1746,64 @@ class MainController:
         self.users = None
         self.wiki_controller = None
         self.workbook_buffer = None
+        self.request_metrics = RequestMetrics()
+        self.stage_profile_controller = StageProfileController(self.config_model.trace_memory)
 
     def run(self):
-        config_type = self.config_model.config_type
-        print(f"Fetching users from {config_type.value}...", end="")
-        users = (self.fetch_users_from_export() if config_type == ConfigType.WIKI else self.fetch_users_from_database())
-        self.users = users
-        print(" Done.")
-        # print(users)
-        print()
-
-        print("Creating users workbook...", end="")
-        self.create_users_workbook()
-        print(" Done.")
-        print("Writing users workbook...", end="")
-        self.write_users_workbook()
-        print(" Done.")
-
-        print("Uploading users workbook...")
-        self.upload_users_workbook()
+        config_model = self.config_model
+        stage = self.stage_profile_controller.stage
+
+        profile = (cProfile.Profile() if config_model.profile_path else None)
+        self.stage_profile_controller.start()
+        if profile is not None:
+            profile.enable()
+
+        try:
+            config_type = config_model.config_type
+            print(f"Fetching users from {config_type.value}...", end="")
+            with stage("fetch"):
+                users = (self.fetch_users_from_export() if config_type == ConfigType.WIKI else self.fetch_users_from_database())
+            self.users = users
+            print(" Done.")
+            # print(users)
+            print()
+
+            print("Creating users workbook...", end="")
+            with stage("build workbook"):
+                self.create_users_workbook()
+            with stage("fix mime type"):
+                self.fix_users_workbook_mime_type()
+            print(" Done.")
+            print("Writing users workbook...", end="")
+            with stage("write file"):
+                self.write_users_workbook()
+            print(" Done.")
+
+            print("Uploading users workbook...")
+            with stage("upload"):
+                self.upload_users_workbook()
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.stage_profile_controller.stop()
+
+            print()
+            self.report_stage_profile(profile)
+            print()
+            self.report_request_metrics()
+
+    def report_stage_profile(self, profile=None):
+        print("Stages:")
+        print(self.stage_profile_controller.format_summary())
+
+        if profile is not None:
+            profile_path = self.config_model.profile_path
+            profile.dump_stats(profile_path)
+            print(f"Wrote the profile to {profile_path}. Read it with: python -m pstats {profile_path}")
+
+    def report_request_metrics(self):
+        config_model = self.config_model
+        self.request_metrics.report(config_model.metrics_json_path, config_model.metrics_prometheus_path)
 
     def fetch_users(self, source_config, Model, Controller):
         model = Model(**source_config)
@@ -825,12 +1819,36 @@ class MainController:
                 username=wiki_config["username"],
                 password=wiki_config["password"]
             ))
-            wiki_controller = WikiController(wiki_model)
-            wiki_controller.login()
+            wiki_controller = WikiController(
+                wiki_model, self.config_model.wiki_session_cache_path, self.request_metrics
+            )
+            with self.stage_profile_controller.stage("login"):
+                wiki_controller.resume_session_or_login()
             self.wiki_controller = wiki_controller
 
+        # Users are streamed, so they are fetched and formatted while the workbook is built. `iterate` still times
+        # fetching and formatting apart from building.
+        stage = self.stage_profile_controller.stage
+        iterate = self.stage_profile_controller.iterate
+
         controller = Controller(model, wiki_controller)
-        users = controller.fetch_formatted_users()
+        config_model = self.config_model
+        user_model = model.user_model
+        if config_model.incremental:
+            if hasattr(controller, "fetch_formatted_users_incrementally"):
+                user_store_controller = UserStoreController(
+                    config_model.user_store_path, user_model.id_field, user_model.fields
+                )
+                users = iterate("fetch", controller.fetch_formatted_users_incrementally(user_store_controller))
+                # The extra sheets read the users more than once.
+                return (UserTable.from_rows(user_model.fields, users) if config_model.extra_sheets else users)
+            warn(f"Incremental runs are not supported for the {controller.config_type} config type. Fetching all users...")
+        if config_model.extra_sheets:
+            user_table = controller.fetch_user_table()
+            with stage("format"):
+                return user_model.format_user_table_dates(user_table)
+        users = iterate("fetch", controller.fetch_users())
+        users = iterate("format", user_model.format_user_dates(users))
         return users
 
     def fetch_users_from_database(self):
@@ -842,24 +1860,50 @@ class MainController:
     def create_users_workbook(self):
         user_model = self.user_model
         users = self.users
+        config_model = self.config_model
         workbook_controller = WorkbookController()
-        with closing(workbook_controller.create_users_workbook(
+        if config_model.extra_sheets:
+            def create_users_workbook(*args):
+                return workbook_controller.create_multi_sheet_users_workbook(*args, processes=config_model.processes or None)
+        elif config_model.workbook_engine == WorkbookEngine.WRITE_ONLY:
+            create_users_workbook = workbook_controller.create_users_workbook_write_only
+        else:
+            create_users_workbook = workbook_controller.create_users_workbook
+        with closing(create_users_workbook(
             user_model.field_title, user_model.fields, user_model.titles, users
         )) as workbook:
             workbook_buffer = BytesIO()
-            workbook.save(workbook_buffer)
-            workbook_buffer = workbook_controller.fix_workbook_mime_type(workbook_buffer)
+            with self.stage_profile_controller.stage("save workbook"):
+                workbook_controller.save_workbook(workbook, workbook_buffer)
             self.workbook_buffer = workbook_buffer
 
+    def fix_users_workbook_mime_type(self):
+        self.workbook_buffer = WorkbookController.fix_workbook_mime_type(self.workbook_buffer)
+
     def write_users_workbook(self):
         with open(self.config_model.users_excel_file_path, "wb") as file:
             file.write(self.workbook_buffer.getvalue())
 
+    def is_users_workbook_uploaded(self):
+        file_sha1 = self.wiki_controller.fetch_file_sha1(self.config_model.users_excel_file_name)
+        workbook_sha1 = hashlib.sha1(self.workbook_buffer.getbuffer()).hexdigest()
+        return file_sha1 == workbook_sha1
+
     def upload_users_workbook(self):
-        # file_data = Path(self.users_excel_file_path).read_bytes()
-        file_data = self.workbook_buffer.getvalue()
+        config_model = self.config_model
         wiki_controller = self.wiki_controller
-        result = wiki_controller.upload_file(self.config_model.users_excel_file_name, file_data)
+
+        if not config_model.force_upload and self.is_users_workbook_uploaded():
+            print("The wiki already has this users workbook. Skipping upload.")
+            return
+        if config_model.upload_chunk_size > 0:
+            result = wiki_controller.upload_file_in_chunks(
+                config_model.users_excel_file_name, config_model.users_excel_file_path, config_model.upload_chunk_size
+            )
+        else:
+            # file_data = Path(self.users_excel_file_path).read_bytes()
+            file_data = self.workbook_buffer.getvalue()
+            result = wiki_controller.upload_file(config_model.users_excel_file_name, file_data)
         uri = result["upload"]["imageinfo"]["descriptionurl"]
         print(uri)
 
@@ -15,10 +15,22 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import argparse
+import asyncio
 import base64
+import hashlib
+import sqlite3
 import requests
 from urllib3.exceptions import InsecureRequestWarning
 
+from journal import Journal
+from rate_controller import RateController, mount_connection_pool, post_with_rate_control, split_into_batches
+from request_metrics import RequestMetrics
+from session_cache import SessionRefresher
+import file_upload
+
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
 session = requests.Session()
@@ -30,6 +42,24 @@ API_ENDPOINT = WIKI_URI + "/api.php"
 USERNAME = "Admin"
 PASSWORD = "adminpass"
 
+JOURNAL_PATH = "./upload_files.journal.jsonl"
+SESSION_CACHE_PATH = "./upload_files.session.json"
+
+WORKERS = 8
+LIMIT = 100
+
+# Maximum number of titles per `prop=imageinfo` query.
+TITLES_QUERY_LIMIT = 50
+
+CACHE_PATH = "./upload_files.sqlite"
+# Maximum number of names per cache query, under SQLite's default limit of 999 parameters.
+CACHE_QUERY_LIMIT = 500
+
+rate_controller = RateController(WORKERS)
+
+request_metrics = RequestMetrics()
+request_metrics.install(session)
+
 
 def fetch_tokens(type):
     body = {
@@ -77,51 +107,271 @@ def login(option):
 
     print(data)
 
+    return data
+
+
+session_refresher = SessionRefresher(session, login, fetch_tokens, request_metrics.record_retry)
+
+
+def resume_session_or_login(option):
+    return session_refresher.resume_session_or_login(API_ENDPOINT, option)
+
+
+def post_write(body, files=None):
+    return post_with_rate_control(session, API_ENDPOINT, body, rate_controller, files, on_retry=request_metrics.record_retry)
+
+
+def post_with_token(body, token_type, token_field="token", files=None):
+    return session_refresher.post_with_token(post_write, body, token_type, token_field, files)
+
+
+def post_with_csrf_token(body, files=None):
+    return post_with_token(body, "csrf", files=files)
+
 
 def upload_file(option):
-    file_name = option["name"]
-    file_data = option["data"]
+    return file_upload.upload_file(post_with_csrf_token, option)
 
-    token = option["token"]
 
-    body = {
-        "action": "upload",
-        "filename": file_name,
-        "token": token,
-        "format": "json",
-        "ignorewarnings": 1
-    }
+def upload_file_in_chunks(option):
+    """
+    Uploads a file in chunks, resuming from the optional "filekey" and "offset". See `file_upload.upload_file_in_chunks`.
+    :param option: "name", "path" and "token", plus optional "chunk_size", "filekey" and "offset".
+    :return: The response data of the final upload, or of the first chunk the wiki rejected.
+    """
 
-    files = {
-        "file": (file_name, file_data, "multipart/form-data")
-    }
+    return file_upload.upload_file_in_chunks(post_with_csrf_token, option, request_metrics.record_retry)
 
-    response = session.post(API_ENDPOINT, files=files, data=body)
+
+def upload_journaled_file(option):
+    """
+    Uploads the file like `upload_file`, and records whether it succeeded in the optional "journal". A request that
+    still fails after the retries is recorded as failed instead of stopping the job.
+    :param option: "name", "data", "token" and an optional "journal".
+    :return: The response data, or None.
+    """
+
+    name = option["name"]
+    journal = option.get("journal")
 
     try:
-        data = response.json()
+        data = upload_file(option)
+    except requests.RequestException as error:
+        print(f"Uploading {name} failed ({error}).")
+        if journal is not None:
+            journal.record_result(name, False, str(error))
+        return None
 
-        print(data)
-    except ValueError:
-        print(response)
-        print(response.content)
+    if journal is not None:
+        succeeded = isinstance(data, dict) and data.get("upload", {}).get("result") == "Success"
+        journal.record_result(name, succeeded, data)
+
+    return data
 
 
 def upload_files(option):
     files = option["files"]
 
     token = option["token"]
+    journal = option.get("journal")
+
+    results = []
 
     for file in files:
         name = file["name"]
         data = file["data"]
 
-        upload_file({
+        results.append(upload_journaled_file({
             "name": name,
             "data": data,
-            "token": token
+            "token": token,
+            "journal": journal
+        }))
+
+    return results
+
+
+def upload_files_concurrently(option):
+    """
+    Uploads the files in parallel over the shared session, which is given a connection pool with one connection per
+    worker. All uploads reuse the same CSRF token.
+    :param option: "files", "token" and an optional "journal" as in `upload_files`, plus an optional "workers" count.
+    :return: The response data of each upload, in the same order as "files".
+    """
+
+    files = option["files"]
+
+    token = option["token"]
+    workers = option.get("workers", WORKERS)
+    journal = option.get("journal")
+
+    mount_connection_pool(session, rate_controller, workers)
+
+    options = ({"name": file["name"], "data": file["data"], "token": token, "journal": journal} for file in files)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(upload_journaled_file, options))
+
+    return results
+
+
+def upload_files_asynchronously(option):
+    """
+    Logs in with its own asynchronous client and uploads all the files at once, with at most "limit" requests in
+    flight.
+    :param option: "files" as in `upload_files`, plus an optional "limit".
+    :return: The response data of each upload, in the same order as "files".
+    """
+
+    # Imported here so that the synchronous functions do not require aiohttp.
+    from mediawiki_client import MediaWikiClient
+
+    files = option["files"]
+
+    limit = option.get("limit", LIMIT)
+
+    async def run():
+        async with MediaWikiClient(API_ENDPOINT, limit=limit) as client:
+            print(await client.login(USERNAME, PASSWORD, WIKI_URI))
+
+            token = await client.fetch_csrf_token()
+
+            return await asyncio.gather(*(
+                client.upload_file(file["name"], file["data"], token) for file in files
+            ))
+
+    return asyncio.run(run())
+
+
+def compute_sha1(file_data):
+    if isinstance(file_data, str):
+        file_data = file_data.encode("utf-8")
+    return hashlib.sha1(file_data).hexdigest()
+
+
+def fetch_file_sha1s(names):
+    """
+    Looks up the SHA-1 of the current revision of each file with `prop=imageinfo`, batching the titles.
+    :param names: File names, without the "File:" prefix.
+    :return: Dictionary of file name to SHA-1, for the files that exist on the wiki.
+    """
+
+    sha1s = {}
+
+    for batch in split_into_batches(list(names), TITLES_QUERY_LIMIT):
+        body = {
+            "action": "query",
+            "prop": "imageinfo",
+            "iiprop": "sha1",
+            "titles": "|".join(f"File:{name}" for name in batch),
+            "format": "json"
+        }
+
+        response = session.get(url=API_ENDPOINT, params=body)
+        data = response.json()
+
+        query = data.get("query", {})
+
+        # The API answers with normalized titles (e.g. "File:a_b.pdf" -> "File:A b.pdf"), so map them back.
+        requested_titles = {f"File:{name}": name for name in batch}
+        for normalized in query.get("normalized", []):
+            requested_titles[normalized["to"]] = requested_titles.get(normalized["from"])
+
+        for page in query.get("pages", {}).values():
+            name = requested_titles.get(page["title"])
+            image_info = page.get("imageinfo")
+            if name is not None and image_info:
+                sha1s[name] = image_info[0]["sha1"]
+
+    return sha1s
+
+
+def open_cache(path):
+    connection = sqlite3.connect(path)
+    connection.execute("create table if not exists files (name text primary key, sha1 text not null)")
+    return connection
+
+
+def read_cached_sha1s(connection, names):
+    """
+    Looks up the cached SHA-1 of each file by its primary key, batching the names, so only the rows of the files at
+    hand are read.
+    :param connection:
+    :param names:
+    :return: Dictionary of file name to SHA-1, for the files in the cache.
+    """
+
+    sha1s = {}
+    for batch in split_into_batches(list(names), CACHE_QUERY_LIMIT):
+        placeholders = ", ".join("?" * len(batch))
+        sha1s.update(connection.execute(f"select name, sha1 from files where name in ({placeholders})", batch))
+
+    return sha1s
+
+
+def write_cached_sha1s(connection, sha1s):
+    with connection:
+        connection.executemany("insert or replace into files (name, sha1) values (?, ?)", sha1s.items())
+
+
+def upload_changed_files(option):
+    """
+    Uploads only the files whose content differs from the wiki. Local SHA-1s are compared with a local cache first,
+    and then with the wiki for the files the cache does not vouch for. Files that are uploaded or found unchanged on
+    the wiki are added to the cache, so later runs need no API calls for them. With "resume", the files the "journal"
+    records as done are skipped before anything else.
+    :param option: "files", "token" and optional "workers" and "journal" as in `upload_files_concurrently`, plus
+        optional "cache_path" and "resume" flag.
+    :return: The response data of each upload, or None for skipped files, in the same order as "files".
+    """
+
+    all_files = option["files"]
+
+    token = option["token"]
+    workers = option.get("workers", WORKERS)
+    cache_path = option.get("cache_path", CACHE_PATH)
+    journal = option.get("journal")
+    resume = option.get("resume", False)
+
+    files = all_files
+    if resume and journal is not None:
+        unfinished_names = set(journal.filter_unfinished(file["name"] for file in all_files))
+        files = [file for file in all_files if file["name"] in unfinished_names]
+        print(f"Skipping {len(all_files) - len(files)} file(s) the journal records as done.")
+
+    local_sha1s = {file["name"]: compute_sha1(file["data"]) for file in files}
+
+    with closing(open_cache(cache_path)) as connection:
+        cached_sha1s = read_cached_sha1s(connection, local_sha1s.keys())
+        unknown_names = [name for name, sha1 in local_sha1s.items() if cached_sha1s.get(name) != sha1]
+
+        wiki_sha1s = (fetch_file_sha1s(unknown_names) if unknown_names else {})
+        write_cached_sha1s(connection, wiki_sha1s)
+
+        changed_names = set(name for name in unknown_names if wiki_sha1s.get(name) != local_sha1s[name])
+        changed_files = [file for file in files if file["name"] in changed_names]
+
+        print(f"Skipping {len(files) - len(changed_files)} unchanged file(s).")
+
+        if journal is not None:
+            for file in files:
+                if file["name"] not in changed_names:
+                    journal.record_result(file["name"], True, "unchanged")
+
+        uploaded = upload_files_concurrently({"files": changed_files, "token": token, "workers": workers, "journal": journal})
+
+        results = {}
+        for file, data in zip(changed_files, uploaded):
+            results[file["name"]] = data
+
+        write_cached_sha1s(connection, {
+            name: local_sha1s[name]
+            for name, data in results.items()
+            if isinstance(data, dict) and data.get("upload", {}).get("result") == "Success"
         })
 
+    return [results.get(file["name"]) for file in all_files]
+
 
 def create_pdf(text):
     return f"""%PDF-1.0
@@ -148,20 +398,34 @@ trailer<</Root 1 0 R>>"""
         {"name": f"Minimal PDF {i}.pdf", "data": create_pdf(i)} for i in range(1, 501)
     )
 
-    print("Fetching login token...")
-    login_token = fetch_login_token()
-    print()
-
-    print("Logging in...")
-    login({"username": USERNAME, "password": PASSWORD, "token": login_token, "return_uri": WIKI_URI})
-    print()
+    parser = argparse.ArgumentParser(description="Uploads the files that differ from the wiki.")
+    parser.add_argument("--resume", help="Skip the files the journal records as done.", action="store_true")
+    parser.add_argument("--metrics-json", help="Write the request metrics to this JSON file.")
+    parser.add_argument("--metrics-prometheus", help="Write the request metrics to this Prometheus textfile collector file, such as requests.prom.")
+    arguments = parser.parse_args(args or None)
 
-    print("Fetching CSRF token...")
-    csrf_token = fetch_csrf_token()
-    print()
-
-    print("Uploading files...")
-    upload_files({"files": files, "token": csrf_token})
+    try:
+        print("Logging in...")
+        session_cache = resume_session_or_login({"username": USERNAME, "password": PASSWORD, "return_uri": WIKI_URI, "session_cache_path": SESSION_CACHE_PATH})
+        print()
+
+        if not session_refresher.logged_in:
+            print("Could not log in. Continuing without caching the session.")
+            print()
+
+        csrf_token = (session_cache or {}).get("csrf_token")
+        if not isinstance(csrf_token, str):
+            print("Fetching CSRF token...")
+            csrf_token = fetch_csrf_token()
+            session_refresher.save_session(csrf_token)
+            print()
+
+        print("Uploading files...")
+        with Journal(JOURNAL_PATH) as journal:
+            upload_changed_files({"files": files, "token": csrf_token, "workers": WORKERS, "cache_path": CACHE_PATH, "journal": journal, "resume": arguments.resume})
+    finally:
+        print()
+        request_metrics.report(arguments.metrics_json, arguments.metrics_prometheus)
 
 
 if __name__ == "__main__":